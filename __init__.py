@@ -9,15 +9,20 @@ from .purchase import *
 def register():
     Pool.register(
         Reservation,
+        ReservationTrace,
+        ReservationGeneration,
         CreateReservationsStart,
+        CreateReservationsProgress,
         WaitReservationStart,
         PrintReservationGraphStart,
+        Location,
         Move,
         Purchase,
         PurchaseRequest,
         PurchaseLine,
         Production,
         Sale,
+        SaleLine,
         ShipmentOut,
         ShipmentOutReturn,
         ShipmentIn,
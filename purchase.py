@@ -1,186 +1,76 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 
+from collections import defaultdict
+
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
-# from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
 from trytond.modules.stock_reservation.stock import delete_related_reservations
 
 
 __all__ = ['PurchaseLine', 'Purchase', 'PurchaseRequest']
 __metaclass__ = PoolMeta
 
-class Purchase:
-    __name__ = 'purchase.purchase'
+
+class SaleTraceMixin:
+    # The stock.reservation.trace field that links to the model
+    _trace_field = None
     sales = fields.Function(fields.One2Many('sale.sale', None, 'Sales'),
         'get_sales', searcher='search_sales')
 
-    def get_sales(self, name):
+    @classmethod
+    def get_sales(cls, records, name):
         pool = Pool()
-        Reservation = pool.get('stock.reservation')
-        SaleLine = pool.get('sale.line')
-        ShipmentOut = pool.get('stock.shipment.out')
-        sales = set()
-        reservations = []
-
-        def get_recursive_moves(moves, processed_moves=None):
-            if not moves:
-                return []
-            if processed_moves is None:
-                processed_moves = set()
-
-            reservations = Reservation.search([
-                    ('source', 'in', moves),
-                    ])
-            new_moves = set([x.destination for x in
-                    reservations if x.destination])
-            for move in moves:
-                if move.id in processed_moves:
-                    continue
-                if move.production_input:
-                    new_moves |= set(move.production_input.outputs)
-                processed_moves.add(move.id)
-
-            reservations += get_recursive_moves(list(new_moves),
-                processed_moves)
-
-            return reservations
-
-        moves = []
-        for shipment in self.shipments + self.shipment_returns:
-            moves += shipment.inventory_moves
-        reservations = get_recursive_moves(moves)
-
-        direct_reservations = Reservation.search([
-                ('source_document', 'in', [str(l) for l in self.lines]),
-                ])
-
-        reservations += direct_reservations
-        reservations += get_recursive_moves([x.destination for x in
-                direct_reservations if x.destination])
-
-        for reservation in reservations:
-            if reservation.destination:
-                if reservation.destination.origin:
-                    origin = reservation.destination.origin
-                    if isinstance(origin, SaleLine):
-                        sales.add(origin.sale)
-            if reservation.destination_document:
-                dest_move = reservation.destination
-                shipment = reservation.destination_document
-                if isinstance(shipment, ShipmentOut):
-                    for move in shipment.outgoing_moves:
-                        if not move.product == dest_move.product:
-                            continue
-                        if move.origin and isinstance(move.origin,
-                                SaleLine):
-                            sales.add(move.origin.sale)
-
-        return [s.id for s in sales]
+        Trace = pool.get('stock.reservation.trace')
+        return Trace.get_related(records, cls._trace_field, 'sale')
 
     @classmethod
     def search_sales(cls, name, clause):
         pool = Pool()
-        Sale = pool.get('sale.sale')
-        purchases = set()
-        for sale in Sale.search([('id',) + tuple(clause[1:])]):
-            for purchase in sale.purchases:
-                purchases.add(purchase.id)
-        return [('id', 'in', purchases)]
+        Trace = pool.get('stock.reservation.trace')
+        return Trace.search_related(cls._trace_field, 'sale', clause)
 
 
-class PurchaseRequest:
-    __name__ = 'purchase.request'
-    sales = fields.Function(fields.One2Many('sale.sale', None, 'Sales'),
-        'get_sales', searcher='search_sales')
-
-    def get_sales(self, name):
-        pool = Pool()
-        Reservation = pool.get('stock.reservation')
-        SaleLine = pool.get('sale.line')
-        ShipmentOut = pool.get('stock.shipment.out')
-        sales = set()
-        reservations = []
-
-        def get_recursive_moves(moves, processed_moves=None):
-            if not moves:
-                return []
-            if processed_moves is None:
-                processed_moves = set()
-
-            reservations = Reservation.search([
-                    ('source', 'in', moves),
-                    ])
-            new_moves = set([x.destination for x in
-                    reservations if x.destination])
-            for move in moves:
-                if move.id in processed_moves:
-                    continue
-                if move.production_input:
-                    new_moves |= set(move.production_input.outputs)
-                processed_moves.add(move.id)
-
-            reservations += get_recursive_moves(list(new_moves),
-                processed_moves)
-
-            return reservations
-
-        direct_reservations = Reservation.search([
-                ('source_document', '=', str(self))])
-
-        reservations = direct_reservations
-        reservations += get_recursive_moves([x.destination for x in
-                direct_reservations if x.destination])
-
-
-        for reservation in reservations:
-            if reservation.destination:
-                if reservation.destination.origin:
-                    origin = reservation.destination.origin
-                    if isinstance(origin, SaleLine):
-                        sales.add(origin.sale)
-            if reservation.destination_document:
-                dest_move = reservation.destination
-                shipment = reservation.destination_document
-                if isinstance(shipment, ShipmentOut):
-                    for move in shipment.outgoing_moves:
-                        if not move.product == dest_move.product:
-                            continue
-                        if move.origin and isinstance(move.origin,
-                                SaleLine):
-                            sales.add(move.origin.sale)
-
-        return [s.id for s in sales]
-
+class Purchase(SaleTraceMixin):
+    __name__ = 'purchase.purchase'
+    _trace_field = 'purchase'
 
 
-    @classmethod
-    def search_sales(cls, name, clause):
-        pool = Pool()
-        Sale = pool.get('sale.sale')
-        requests = set()
-        for sale in Sale.search([('id',) + tuple(clause[1:])]):
-            for request in sale.purchase_requests:
-                requests.add(request.id)
-        return [('id', 'in', requests)]
+class PurchaseRequest(SaleTraceMixin):
+    __name__ = 'purchase.request'
+    _trace_field = 'purchase_request'
 
     @classmethod
     def write(cls, *args):
         pool = Pool()
         Reservation = pool.get('stock.reservation')
+
         actions = iter(args)
+        request2line = {}
+        for requests, values in zip(actions, actions):
+            if values.get('purchase_line'):
+                for request in requests:
+                    request2line[request.id] = values['purchase_line']
+
         super(PurchaseRequest, cls).write(*args)
-        for requests, value in zip(actions, actions):
-            if 'purchase_line' in value:
-                reserves = Reservation.search([
+
+        line2reserves = defaultdict(list)
+        for sub_ids in grouped_slice(request2line.keys()):
+            for reserve in Reservation.search([
                         ('state', 'in', ['draft', 'waiting']),
-                        ('source_document', 'in', [str(r) for r in requests]),
-                        ])
-                if reserves:
-                    Reservation.write(reserves, {
-                            'source_document': ('purchase.line,%d' %
-                                value.get('purchase_line')),
-                            })
+                        ('source_document_model', '=', 'purchase.request'),
+                        ('source_document_id', 'in', list(sub_ids)),
+                        ], order=[]):
+                line2reserves[request2line[reserve.source_document_id]
+                    ].append(reserve)
+        to_write = []
+        for line_id, reserves in line2reserves.iteritems():
+            to_write.extend((reserves, {
+                        'source_document': 'purchase.line,%d' % line_id,
+                        }))
+        if to_write:
+            Reservation.write(*to_write)
 
     @classmethod
     def delete(cls, requests):
@@ -213,6 +103,24 @@ class PurchaseLine:
         return Purchase.purchase_date.convert_order('purchase_date',
             tables['purchase'], Purchase)
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Trace = pool.get('stock.reservation.trace')
+        actions = iter(args)
+        to_trace = []
+        for lines, values in zip(actions, actions):
+            if 'purchase' in values:
+                to_trace.extend(lines)
+        super(PurchaseLine, cls).write(*args)
+        if to_trace:
+            # The traces keep the purchase line so its sales are known
+            sales = set()
+            for sale_ids in Trace.get_related(to_trace, 'purchase_line',
+                    'sale').itervalues():
+                sales.update(sale_ids)
+            Trace.update_sales(sales)
+
     @classmethod
     def delete(cls, lines):
         delete_related_reservations(lines, 'source_document')
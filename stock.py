@@ -1,49 +1,96 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import hashlib
+import json
+import logging
+import subprocess
+import threading
 from collections import defaultdict
-from datetime import datetime
-from sql import Literal, Cast
-from sql.operators import Concat
-from sql.conditionals import Case
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
+from sql import Column, Literal, Cast, Null, Union, With
+from sql.aggregate import Count, Max, Min, Sum
+from sql.operators import Concat, Like, Or
+from sql.conditionals import Case, Coalesce
+from sql.functions import CharLength, CurrentTimestamp, Function, Position, \
+    Substring
 
 from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.error import WarningErrorMixin
 from trytond.model import Workflow, Model, ModelSQL, ModelView, fields
 from trytond.report import Report
 from trytond.pyson import Eval, If, In
 from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.wizard import Wizard, StateView, StateAction, StateTransition, \
     Button
 from trytond.rpc import RPC
 
 
-__all__ = ['Reservation', 'WaitReservation', 'WaitReservationStart',
-    'CreateReservations', 'CreateReservationsStart',
+__all__ = ['Reservation', 'ReservationTrace',
+    'WaitReservation', 'WaitReservationStart',
+    'ReservationGeneration', 'CreateReservations', 'CreateReservationsStart',
+    'CreateReservationsProgress',
     'PrintReservationGraphStart', 'PrintReservationGraph', 'ReservationGraph',
-    'Move', 'Production', 'Sale',
+    'Location', 'Move', 'Production', 'Sale', 'SaleLine',
     'ShipmentOut', 'ShipmentOutReturn', 'ShipmentIn', 'ShipmentInternal',]
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
 STATES = {
     'readonly': Eval('state') != 'draft',
 }
 DEPENDS = ['state']
 
 
+class JulianDay(Function):
+    __slots__ = ()
+    _function = 'JULIANDAY'
+
+
+class GenerationAborted(Exception):
+    'Raised when the generation of reservations is no longer running'
+
+
 def delete_related_reservations(records, field):
     assert field in ('source_document', 'destination_document')
     pool = Pool()
     Reservation = pool.get('stock.reservation')
-    reserves = Reservation.search([
-            (field, 'in', [str(r) for r in records]),
-            ])
-    if reserves:
-        Reservation.delete(reserves)
+    reservation = Reservation.__table__()
+    cursor = Transaction().connection.cursor()
+
+    wheres = []
+    if field == 'source_document':
+        ids_by_model = defaultdict(list)
+        for record in records:
+            ids_by_model[record.__name__].append(record.id)
+        for model, ids in ids_by_model.iteritems():
+            for sub_ids in grouped_slice(ids):
+                wheres.append((reservation.source_document_model == model)
+                    & reduce_ids(reservation.source_document_id, sub_ids))
+    else:
+        for sub_records in grouped_slice(records):
+            wheres.append(reservation.destination_document.in_(
+                    [str(r) for r in sub_records]))
+    reservation_ids = []
+    for where in wheres:
+        cursor.execute(*reservation.select(reservation.id, where=where))
+        reservation_ids.extend(r for r, in cursor.fetchall())
+    # Delete through the ORM for the access rules, the draft check, the
+    # sale traces and the overrides of other modules
+    for sub_ids in grouped_slice(reservation_ids):
+        Reservation.delete(Reservation.browse(list(sub_ids)))
 
 
 class Reservation(Workflow, ModelSQL, ModelView):
     "Stock Reservation"
     __name__ = 'stock.reservation'
+    _document_selection_cache = Cache(
+        'stock.reservation.document_selection', context=False)
 
     company = fields.Many2One('company.company', 'Company', required=True,
         states=STATES, depends=DEPENDS,
@@ -70,11 +117,12 @@ class Reservation(Workflow, ModelSQL, ModelView):
         'on_change_with_internal_quantity')
     source_document = fields.Reference('Source',
         selection='get_source_document', states=STATES, depends=DEPENDS)
+    source_document_model = fields.Char('Source Model', readonly=True)
+    source_document_id = fields.Integer('Source ID', readonly=True)
     location = fields.Many2One('stock.location', 'Location', select=True,
         required=True, domain=[('type', 'in', ['view', 'storage', 'production'])],
         states=STATES, depends=DEPENDS)
     destination = fields.Many2One('stock.move', 'Destination Move',
-        select=True,
         states={
             'readonly': (Eval('state') != 'draft') | ~Eval('location'),
             'required': Eval('state') == 'done',
@@ -86,17 +134,17 @@ class Reservation(Workflow, ModelSQL, ModelView):
             ('from_location', '=', Eval('location', -1)),
             ],
         ondelete='CASCADE')
-    destination_document = fields.Function(fields.Reference('Destination',
-        selection='get_destination_document_selection'),
-        'get_destination_document', searcher='search_destination_document')
+    destination_document = fields.Reference('Destination',
+        selection='get_destination_document_selection', select=True,
+        readonly=True)
     destination_planned_date = fields.Function(fields.Date('Planned Date'),
-        'get_move_field', searcher='search_move_field')
+        'get_move_fields', searcher='search_move_field')
     destination_from_location = fields.Function(fields.Many2One(
             'stock.location', 'From Location'),
-        'get_move_field')
+        'get_move_fields')
     destination_to_location = fields.Function(fields.Many2One(
             'stock.location', 'To Location'),
-        'get_move_field')
+        'get_move_fields')
     get_from_stock = fields.Boolean('Get from stock')
     stock_location = fields.Many2One('stock.location', 'Stock Location',
         domain=[
@@ -109,7 +157,7 @@ class Reservation(Workflow, ModelSQL, ModelView):
             'required': Eval('get_from_stock', False),
         },
         depends=DEPENDS + ['get_from_stock', 'location'])
-    source = fields.Many2One('stock.move', 'Source Move', select=True,
+    source = fields.Many2One('stock.move', 'Source Move',
         states={
             'readonly': (Eval('state') != 'draft') | ~Eval('location'),
             'required': ((Eval('state') == 'done') &
@@ -135,14 +183,14 @@ class Reservation(Workflow, ModelSQL, ModelView):
                 'invisible': Eval('get_from_stock', False),
                 },
             depends=['get_from_stock']),
-        'get_move_field')
+        'get_move_fields')
     source_to_location = fields.Function(fields.Many2One('stock.location',
             'To Location',
             states={
                 'invisible': Eval('get_from_stock', False),
                 },
             depends=['get_from_stock']),
-        'get_move_field')
+        'get_move_fields')
     failed_reason = fields.Selection([
             (None, ''),
             ('source_canceled', 'Source Move was canceled'),
@@ -195,20 +243,95 @@ class Reservation(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def __register__(cls, module_name):
+        pool = Pool()
+        Move = pool.get('stock.move')
         TableHandler = backend.get('TableHandler')
         cursor = Transaction().connection.cursor()
         table = TableHandler(cls, module_name)
         sql_table = cls.__table__()
+        move = Move.__table__()
 
         created_stock_location = not table.column_exist('stock_location')
+        created_destination_document = not table.column_exist(
+            'destination_document')
+        created_source_document_id = not table.column_exist(
+            'source_document_id')
 
         super(Reservation, cls).__register__(module_name)
 
+        # The models or their names may have changed with the modules
+        cls._document_selection_cache.clear()
+
         # Migration from 3.4: new stock_location field
         if created_stock_location:
             cursor.execute(*sql_table.update([sql_table.stock_location],
                     [sql_table.location], where=sql_table.get_from_stock))
 
+        # Migration from 4.0: destination_document is stored
+        if created_destination_document:
+            Char = cls.state.sql_type().base
+            cursor.execute(*sql_table.update(
+                    [sql_table.destination_document],
+                    [move.select(Case(
+                                (move.production_input != None,
+                                    Concat(Literal('production,'),
+                                        Cast(move.production_input, Char))),
+                                (move.production_output != None,
+                                    Concat(Literal('production,'),
+                                        Cast(move.production_output, Char))),
+                                else_=move.shipment),
+                            where=move.id == sql_table.destination)],
+                    where=sql_table.destination != None))
+            models = cls._get_destination_document_models()
+            cursor.execute(*sql_table.update(
+                    [sql_table.destination_document], [Null],
+                    where=~Or([Like(sql_table.destination_document,
+                                '%s,%%' % m) for m in models])))
+
+        # Migration from 4.0: split source_document into model and id
+        if created_source_document_id:
+            Integer = cls.id.sql_type().base
+            position = Position(',', sql_table.source_document)
+            cursor.execute(*sql_table.update(
+                    [sql_table.source_document_model,
+                        sql_table.source_document_id],
+                    [Substring(sql_table.source_document, 1, position - 1),
+                        Cast(Substring(sql_table.source_document,
+                                position + 1), Integer)],
+                    where=(position > 1)
+                    & (position < CharLength(sql_table.source_document))))
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['source_document_model', 'source_document_id'],
+            'add')
+        # Migration from 4.0: source and destination single column indexes
+        # are replaced by composite indexes with state
+        table.index_action(['destination', 'state'], 'add')
+        table.index_action(['source', 'state'], 'add')
+        if backend.name() == 'postgresql':
+            # TableHandler does not support partial indexes and
+            # CREATE INDEX IF NOT EXISTS requires PostgreSQL 9.5
+            for name, columns, states in cls._partial_indexes():
+                index_name = '%s_%s' % (cls._table, name)
+                if index_name in table._indexes:
+                    continue
+                cursor.execute('CREATE INDEX "%s" ON "%s" (%s) '
+                    'WHERE "state" IN (%s)' % (index_name, cls._table,
+                        ', '.join('"%s"' % c for c in columns),
+                        ', '.join("'%s'" % s for s in states)))
+
+    @classmethod
+    def _partial_indexes(cls):
+        '''
+        Return a list of (name, columns, states) for the partial indexes
+        created on PostgreSQL on the reservations in one of the states
+        '''
+        return [
+            ('open_destination_index', ['destination'], ['draft', 'waiting']),
+            ('open_source_index', ['source'], ['draft', 'waiting']),
+            ('open_product_index', ['product'], ['draft', 'waiting']),
+            ]
+
     @classmethod
     def __setup__(cls):
         super(Reservation, cls).__setup__()
@@ -281,6 +404,32 @@ class Reservation(Workflow, ModelSQL, ModelView):
             return res.id
         return res
 
+    @classmethod
+    def get_move_fields(cls, reservations, names):
+        query, reservation, source, destination = cls._get_moves_join()
+        cursor = Transaction().connection.cursor()
+
+        moves = {
+            'source': source,
+            'destination': destination,
+            }
+        columns = []
+        for name in names:
+            move_name, field_name = name.split('_', 1)
+            columns.append(getattr(moves[move_name], field_name))
+
+        res = {}
+        for name in names:
+            res[name] = dict((r.id, None) for r in reservations)
+
+        for sub_ids in grouped_slice([r.id for r in reservations]):
+            cursor.execute(*query.select(reservation.id, *columns,
+                    where=reduce_ids(reservation.id, sub_ids)))
+            for row in cursor.fetchall():
+                for name, value in zip(names, row[1:]):
+                    res[name][row[0]] = value
+        return res
+
     @classmethod
     def search_move_field(cls, name, clause):
         move_name, field_name = name.split('_', 1)
@@ -345,15 +494,25 @@ class Reservation(Workflow, ModelSQL, ModelView):
             'purchase.line',
             ]
 
+    @classmethod
+    def _get_document_selection(cls, name, models):
+        'Return the selection of models, cached by name, models and language'
+        key = (name, tuple(models), Transaction().language)
+        selection = cls._document_selection_cache.get(key)
+        if selection is not None:
+            return selection
+        Model = Pool().get('ir.model')
+        selection = [('', '')] + [(m.model, m.name)
+            for m in Model.search([
+                    ('model', 'in', models),
+                    ])]
+        cls._document_selection_cache.set(key, selection)
+        return selection
+
     @classmethod
     def get_source_document(cls):
-        pool = Pool()
-        Model = pool.get('ir.model')
-        models = cls._get_source_document()
-        models = Model.search([
-                ('model', 'in', models),
-                ])
-        return [('', '')] + [(m.model, m.name) for m in models]
+        return cls._get_document_selection('source_document',
+            cls._get_source_document())
 
     @classmethod
     def _get_destination_document_models(cls):
@@ -367,24 +526,37 @@ class Reservation(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def get_destination_document_selection(cls):
-        pool = Pool()
-        Model = pool.get('ir.model')
-        models = cls._get_destination_document_models()
-        models = Model.search([
-                ('model', 'in', models),
-                ])
-        return [('', '')] + [(m.model, m.name) for m in models]
+        return cls._get_document_selection('destination_document',
+            cls._get_destination_document_models())
 
-    def get_destination_document(self, name):
-        if not self.destination:
+    @classmethod
+    def _get_destination_document(cls, move):
+        'Return the destination_document value for the destination move'
+        if not move:
             return None
-        if self.destination.production_input:
-            return str(self.destination.production_input)
-        if self.destination.production_output:
-            return str(self.destination.production_output)
-        if self.destination.shipment:
-            return str(self.destination.shipment)
-        return ''
+        document = (move.production_input or move.production_output
+            or move.shipment)
+        if (document
+                and document.__name__ in
+                cls._get_destination_document_models()):
+            return str(document)
+        return None
+
+    @classmethod
+    def update_destination_document(cls, reservations):
+        'Update destination_document from the destination move'
+        to_write = defaultdict(list)
+        for reservation in reservations:
+            document = cls._get_destination_document(
+                reservation.destination)
+            if document != (str(reservation.destination_document)
+                    if reservation.destination_document else None):
+                to_write[document].append(reservation)
+        args = []
+        for document, records in to_write.iteritems():
+            args.extend((records, {'destination_document': document}))
+        if args:
+            cls.write(*args)
 
     def get_shipments(model_name):
         "Computes the returns or shipments"
@@ -416,21 +588,48 @@ class Reservation(Workflow, ModelSQL, ModelView):
                 productions.add(move.production_output.id)
         return list(productions)
 
-    def get_sales(self, name):
+    @classmethod
+    def _get_shipment_origins(cls, reservations, shipment_models,
+            origin_model):
+        '''
+        Return a dictionary with the ids of the origin_model records of the
+        moves in the shipments of shipment_models of each reservation
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        reservation = cls.__table__()
+        move = Move.__table__()
+        shipment_move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        res = dict((r.id, set()) for r in reservations)
+        query = reservation.join(move, condition=(
+                (move.id == reservation.source)
+                | (move.id == reservation.destination))).join(shipment_move,
+            condition=shipment_move.shipment == move.shipment)
+        where = (Or([Like(move.shipment, '%s,%%' % m)
+                    for m in shipment_models])
+            & Like(shipment_move.origin, '%s,%%' % origin_model))
+        for sub_ids in grouped_slice(res.keys()):
+            cursor.execute(*query.select(reservation.id, shipment_move.origin,
+                    where=reduce_ids(reservation.id, sub_ids) & where))
+            for reservation_id, origin in cursor.fetchall():
+                res[reservation_id].add(int(origin.split(',')[1]))
+        return res
+
+    @classmethod
+    def get_sales(cls, reservations, name):
         pool = Pool()
         SaleLine = pool.get('sale.line')
-        shipments = self.customer_shipments + self.customer_return_shipments
-        move_ids = []
-        for shipment in shipments:
-            move_ids.extend([x.id for x in shipment.outgoing_moves])
 
+        lines = cls._get_shipment_origins(reservations,
+            ['stock.shipment.out', 'stock.shipment.out.return'], 'sale.line')
+        line_ids = list(set(l for ls in lines.itervalues() for l in ls))
         with Transaction().set_user(0, set_context=True):
-            sale_lines = SaleLine.search([
-                    ('moves', 'in', move_ids),
-                    ])
-            if sale_lines:
-                return list(set(l.sale.id for l in sale_lines))
-        return []
+            sales = dict((l['id'], l['sale'])
+                for l in SaleLine.read(line_ids, ['sale']))
+        return dict((r, list(set(sales[l] for l in ls)))
+            for r, ls in lines.iteritems())
 
     def get_reserve_type(self, name):
         if self.get_from_stock:
@@ -462,24 +661,23 @@ class Reservation(Workflow, ModelSQL, ModelView):
             if source and destination:
                 return (destination - source).days
 
-    def get_purchases(self, name):
+    @classmethod
+    def get_purchases(cls, reservations, name):
         pool = Pool()
         PurchaseLine = pool.get('purchase.line')
-        shipments = self.supplier_shipments + self.supplier_return_shipments
-        move_ids = []
-        for shipment in shipments:
-            move_ids.extend([x.id for x in shipment.outgoing_moves])
 
-        res = []
+        lines = cls._get_shipment_origins(reservations,
+            ['stock.shipment.in', 'stock.shipment.in.return'],
+            'purchase.line')
+        for reservation in reservations:
+            if reservation.source_document_model == 'purchase.line':
+                lines[reservation.id].add(reservation.source_document_id)
+        line_ids = list(set(l for ls in lines.itervalues() for l in ls))
         with Transaction().set_user(0, set_context=True):
-            purchase_lines = PurchaseLine.search([
-                    ('moves', 'in', move_ids),
-                    ])
-            if purchase_lines:
-                res.extend(list(set(l.purchase for l in purchase_lines)))
-        if self.origin and isinstance(self.origin, PurchaseLine):
-            res.append(self.origin.purchase.id)
-        return res
+            purchases = dict((l['id'], l['purchase'])
+                for l in PurchaseLine.read(line_ids, ['purchase']))
+        return dict((r, list(set(purchases[l] for l in ls)))
+            for r, ls in lines.iteritems())
 
     def get_related_purchase_requests(self, name):
         pool = Pool()
@@ -490,60 +688,66 @@ class Reservation(Workflow, ModelSQL, ModelView):
         return res
 
     @classmethod
-    def search_reserve_type(cls, name, clause):
-        reservation = cls.__table__()
-        Operator = fields.SQL_OPERATORS[clause[1]]
+    def _get_day_difference_sql(cls, reservation, source, destination):
+        '''
+        Return the SQL expression of day_difference for the reservation table
+        joined to its source and destination moves
+        '''
+        if backend.name() == 'sqlite':
+            Integer = cls.id.sql_type().base
 
-        day_difference = cls.search_day_difference('day_difference',
-            ('day_difference', '<', 0))
-        _, _, date_query = day_difference[0]
-
-        query = reservation.select(reservation.id,
-            where=(Operator(Case(
-                        (reservation.get_from_stock, Literal('in_stock')),
-                        ((((reservation.source != None) |
-                                    (reservation.source_document != None))
-                                & (reservation.destination == None)),
-                            Literal('exceeding')),
-                        (((reservation.source == None) &
-                                    (reservation.source_document == None) &
-                                (reservation.destination != None)),
-                            Literal('pending')),
-                        (reservation.id.in_(date_query), Literal('delayed')),
-                        else_=Literal('on_time')), clause[2])))
+            def difference(start, end):
+                return Cast(JulianDay(end) - JulianDay(start), Integer)
+        else:
+            def difference(start, end):
+                return end - start
+        return Case((reservation.state == 'done',
+                difference(source.effective_date,
+                    destination.effective_date)),
+            else_=difference(source.planned_date, destination.planned_date))
 
-        return [('id', 'in', query)]
+    @classmethod
+    def _get_reserve_type_sql(cls, reservation, source, destination):
+        '''
+        Return the SQL expression of reserve_type for the reservation table
+        joined to its source and destination moves
+        '''
+        has_source = ((reservation.source != Null)
+            | (reservation.source_document != Null))
+        return Case(
+            (reservation.get_from_stock, Literal('in_stock')),
+            (has_source & (reservation.destination == Null),
+                Literal('exceeding')),
+            (~has_source & (reservation.destination != Null),
+                Literal('pending')),
+            (cls._get_day_difference_sql(reservation, source, destination)
+                < 0, Literal('delayed')),
+            else_=Literal('on_time'))
 
     @classmethod
-    def search_destination_document(cls, name, clause):
+    def _get_moves_join(cls):
+        '''
+        Return the reservation table with its source and destination moves
+        left joined
+        '''
         pool = Pool()
         Move = pool.get('stock.move')
-        destination = Move.__table__()
         reservation = cls.__table__()
+        source = Move.__table__()
+        destination = Move.__table__()
+        join = reservation.join(source, 'LEFT',
+            condition=reservation.source == source.id
+            ).join(destination, 'LEFT',
+            condition=reservation.destination == destination.id)
+        return join, reservation, source, destination
 
+    @classmethod
+    def search_reserve_type(cls, name, clause):
         Operator = fields.SQL_OPERATORS[clause[1]]
-        Char = cls.state.sql_type().base
-        value = clause[2]
-        if isinstance(value, list):
-            if clause[1] in ('in', 'not in'):
-                value = [str(x) for x in value]
-            else:
-                value = ','.join([str(x) for x in value])
-        query = reservation.join(destination, condition=(
-                destination.id == reservation.destination)).select(
-                    reservation.id,
-            where=(Operator(Case(
-                        ((destination.shipment != None),
-                            destination.shipment),
-                        ((destination.production_input != None) &
-                            Concat(Literal('production,'), Cast(
-                                            destination.production_input,
-                                            Char))),
-                        ((destination.production_output != None) &
-                            Concat(Literal('production,'), Cast(
-                                            destination.production_output,
-                                            Char))),
-                        ), value)))
+        join, reservation, source, destination = cls._get_moves_join()
+        query = join.select(reservation.id,
+            where=Operator(cls._get_reserve_type_sql(
+                    reservation, source, destination), clause[2]))
         return [('id', 'in', query)]
 
     @classmethod
@@ -551,56 +755,164 @@ class Reservation(Workflow, ModelSQL, ModelView):
         pool = Pool()
         Move = pool.get('stock.move')
         moves = Move.search([('sale',) + tuple(clause[1:])])
-        shipments = list(set([m.shipment for m in moves if m.shipment]))
+        shipments = list(set([str(m.shipment) for m in moves if m.shipment]))
         return [('destination_document', 'in', shipments)]
 
     @classmethod
     def search_day_difference(cls, name, clause):
-        pool = Pool()
-        Move = pool.get('stock.move')
-        reservation = cls.__table__()
-        source = Move.__table__()
-        destination = Move.__table__()
         Operator = fields.SQL_OPERATORS[clause[1]]
-        query = reservation.join(source, condition=(
-                reservation.source == source.id)).join(destination, condition=(
-                        reservation.destination == destination.id)).select(
-                            reservation.id, where=(Operator((
-                                    destination.planned_date -
-                                        source.planned_date), clause[2])
-                                    ))
+        join, reservation, source, destination = cls._get_moves_join()
+        query = join.select(reservation.id,
+            where=Operator(cls._get_day_difference_sql(
+                    reservation, source, destination), clause[2]))
         return [('id', 'in', query)]
 
     @classmethod
     def search_purchases(cls, name, clause):
-        return [tuple(('source_document.purchase',)) + tuple(clause[1:]) +
-            tuple(('purchase.line',))]
+        pool = Pool()
+        PurchaseLine = pool.get('purchase.line')
+        lines = PurchaseLine.search([
+                ('purchase',) + tuple(clause[1:]),
+                ], order=[], query=True)
+        return [
+            ('source_document_model', '=', 'purchase.line'),
+            ('source_document_id', 'in', lines),
+            ]
 
     @classmethod
     def search_purchase_requests(cls, name, clause):
-        return [tuple(('source_document.id',)) + tuple(clause[1:]) +
-            tuple(('purchase.request',))]
+        return [
+            ('source_document_model', '=', 'purchase.request'),
+            ('source_document_id',) + tuple(clause[1:]),
+            ]
+
+    @staticmethod
+    def _get_source_document_values(value):
+        'Return source_document_model and source_document_id for value'
+        if isinstance(value, Model):
+            value = str(value)
+        elif isinstance(value, (list, tuple)):
+            value = '%s,%s' % tuple(value)
+        model, id_ = None, None
+        if value and ',' in value:
+            model, id_ = value.split(',', 1)
+            try:
+                id_ = int(id_)
+            except ValueError:
+                id_ = None
+            if id_ is None or id_ < 0:
+                model, id_ = None, None
+        return {
+            'source_document_model': model,
+            'source_document_id': id_,
+            }
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Trace = pool.get('stock.reservation.trace')
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            values.update(cls._get_source_document_values(
+                    values.get('source_document')))
+        moves = Move.browse(list(set(v['destination'] for v in vlist
+                    if v.get('destination')
+                    and 'destination_document' not in v)))
+        moves = dict((m.id, m) for m in moves)
+        for values in vlist:
+            if values.get('destination') in moves:
+                values['destination_document'] = (
+                    cls._get_destination_document(
+                        moves[values['destination']]))
+        reservations = super(Reservation, cls).create(vlist)
+        if not Transaction().context.get('skip_reservation_trace'):
+            Trace.update_sales(Trace.get_affected_sales(reservations))
+        return reservations
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Trace = pool.get('stock.reservation.trace')
+        actions = iter(args)
+        args = []
+        to_update = []
+        to_trace = []
+        for reservations, values in zip(actions, actions):
+            if ('destination' in values
+                    and 'destination_document' not in values):
+                to_update.extend(reservations)
+            if 'source_document' in values:
+                values = values.copy()
+                values.update(cls._get_source_document_values(
+                        values['source_document']))
+            if set(values.keys()) & set(Trace._reservation_fields):
+                to_trace.extend(reservations)
+            args.extend((reservations, values))
+        if Transaction().context.get('skip_reservation_trace'):
+            to_trace = []
+        sales = Trace.get_traced_sales(to_trace)
+        super(Reservation, cls).write(*args)
+        if to_update:
+            cls.update_destination_document(cls.browse(to_update))
+        if to_trace:
+            sales |= Trace.get_affected_sales(to_trace)
+            Trace.update_sales(sales)
 
     @classmethod
     def delete(cls, reservations):
+        pool = Pool()
+        Trace = pool.get('stock.reservation.trace')
         for reserve in reservations:
             if reserve.state != 'draft':
                 cls.raise_user_error('delete_draft', (reserve.rec_name,))
+        if Transaction().context.get('skip_reservation_trace'):
+            super(Reservation, cls).delete(reservations)
+            return
+        sales = Trace.get_traced_sales(reservations)
         super(Reservation, cls).delete(reservations)
+        Trace.update_sales(sales)
+
+    @classmethod
+    def _get_moves_by_state(cls, reservations):
+        """
+        Return the ids of the source and destination moves of reservations
+        grouped by (field name, move state).
+        """
+        query_from, reservation, source, destination = cls._get_moves_join()
+        cursor = Transaction().connection.cursor()
+
+        moves = defaultdict(set)
+        for sub_ids in grouped_slice([r.id for r in reservations]):
+            cursor.execute(*query_from.select(
+                    source.id, source.state,
+                    destination.id, destination.state,
+                    where=reduce_ids(reservation.id, sub_ids)))
+            for (source_id, source_state, destination_id,
+                    destination_state) in cursor.fetchall():
+                if source_id:
+                    moves[('source', source_state)].add(source_id)
+                if destination_id:
+                    moves[('destination', destination_state)].add(
+                        destination_id)
+        return moves
+
+    @staticmethod
+    def _process_moves(method, move_ids):
+        'Call method of stock.move on move_ids in grouped batches'
+        Move = Pool().get('stock.move')
+        for sub_ids in grouped_slice(sorted(move_ids)):
+            getattr(Move, method)(Move.browse(list(sub_ids)))
 
     @classmethod
     @ModelView.button
     @Workflow.transition('draft')
     def draft(cls, reservations):
-        pool = Pool()
-        Move = pool.get('stock.move')
-
-        moves = ([r.source for r in reservations
-                if r.source and r.state != 'done'] +
-            [r.destination for r in reservations
-                if r.destination and r.state != 'done'])
+        moves = cls._get_moves_by_state([r for r in reservations
+                if r.state != 'done'])
+        move_ids = set().union(*moves.itervalues())
         with Transaction().set_context(stock_reservation=True):
-            Move.draft(moves)
+            cls._process_moves('draft', move_ids)
 
     @classmethod
     @ModelView.button
@@ -615,41 +927,23 @@ class Reservation(Workflow, ModelSQL, ModelView):
     @ModelView.button
     @Workflow.transition('failed')
     def fail(cls, reservations):
-        pool = Pool()
-        Move = pool.get('stock.move')
-        moves = []
-        for reservation in reservations:
-            if reservation.source and reservation.source.state == 'assigned':
-                moves.append(reservation.source)
-            if (reservation.destination and
-                    reservation.destination.state == 'assigned'):
-                moves.append(reservation.destination)
+        moves = cls._get_moves_by_state(reservations)
+        move_ids = (moves[('source', 'assigned')]
+            | moves[('destination', 'assigned')])
         with Transaction().set_context(stock_reservation=True):
-            Move.draft(moves)
+            cls._process_moves('draft', move_ids)
 
     @classmethod
     @ModelView.button
     @Workflow.transition('done')
     def do(cls, reservations):
-        pool = Pool()
-        Move = pool.get('stock.move')
-
-        to_assign = []
-        to_do = []
-        for reservation in reservations:
-            # TODO: Determine when to split moves
-            # reservation.split_moves('done')
-            if reservation.source and reservation.source.state == 'assigned':
-                to_do.append(reservation.source)
-            if (reservation.destination and
-                    reservation.destination.state == 'draft'):
-                to_assign.append(reservation.destination)
+        # TODO: Determine when to split moves
+        # reservation.split_moves('done')
+        moves = cls._get_moves_by_state(reservations)
 
         cls.write(reservations, {'state': 'done'})
-        if to_assign:
-            Move.assign(to_assign)
-        if to_do:
-            Move.do(to_do)
+        cls._process_moves('assign', moves[('destination', 'draft')])
+        cls._process_moves('do', moves[('source', 'assigned')])
 
     def split_moves(self, next_state):
         """
@@ -684,26 +978,38 @@ class Reservation(Workflow, ModelSQL, ModelView):
                 self.write(reservations, {move_name: new_move})
 
     @classmethod
-    def generate_reservations(cls, clean=True):
+    def generate_reservations(cls, clean=True, progress=None):
         """
         Compute all available reservations based on draft stock moves.
 
         If clean is set, it will remove all previous reservations.
+        If progress is set, it is called with the name of the current phase,
+        the completed percentage and, while creating, the number of created
+        reservations.
+        The traces are computed once at the end instead of on each batch.
         """
         pool = Pool()
         Date = pool.get('ir.date')
         Location = pool.get('stock.location')
         Product = pool.get('product.product')
-        PurchaseLine = pool.get('purchase.line')
-        PurchaseRequest = pool.get('purchase.request')
+        Trace = pool.get('stock.reservation.trace')
         Uom = pool.get('product.uom')
 
+        if progress is None:
+            def progress(phase, percentage, created=None):
+                pass
+
+        sales = set()
         if clean:
+            progress('clean', 0)
             reservations = cls.search([
                     ('state', '=', 'draft'),
                     ])
-            cls.delete(reservations)
+            sales = Trace.get_traced_sales(reservations)
+            with Transaction().set_context(skip_reservation_trace=True):
+                cls.delete(reservations)
 
+        progress('stock', 5)
         destination_moves = cls.get_destination_moves()
 
         location_ids = [l.id for l in Location.search([
@@ -714,8 +1020,12 @@ class Reservation(Workflow, ModelSQL, ModelView):
             pbl = Product.products_by_location(location_ids, product_ids)
 
         consumed_quantities = {}
+        source_document_keys = {
+            'purchase.line': 'purchase_line',
+            'purchase.request': 'purchase_request',
+            }
         for reservation in cls.search([
-                    ('state', 'not in', ['done', 'failed']),
+                    ('state', 'in', ['draft', 'waiting']),
                     ]):
             if reservation.get_from_stock:
                 key = (reservation.stock_location.id, reservation.product.id)
@@ -737,17 +1047,13 @@ class Reservation(Workflow, ModelSQL, ModelView):
                     consumed_quantities[key] = 0
                 # TODO: Currently not converting uom.
                 consumed_quantities[key] += reservation.internal_quantity
-            source_document = reservation.source_document
-            if source_document:
-                key = None
-                if isinstance(source_document, PurchaseLine):
-                    key = ('purchase_line', source_document.id,)
-                elif isinstance(source_document, PurchaseRequest):
-                    key = ('purchase_request', source_document.id,)
-                if key:
-                    if key not in consumed_quantities:
-                        consumed_quantities[key] = 0
-                    consumed_quantities[key] += reservation.internal_quantity
+            model = reservation.source_document_model
+            if model in source_document_keys:
+                key = (source_document_keys[model],
+                    reservation.source_document_id,)
+                if key not in consumed_quantities:
+                    consumed_quantities[key] = 0
+                consumed_quantities[key] += reservation.internal_quantity
 
         requests = cls.get_purchase_requests()
         purchase_lines = cls.get_purchase_lines()
@@ -811,7 +1117,8 @@ class Reservation(Workflow, ModelSQL, ModelView):
                     - quantity)
 
         child_locations = {}
-        for destination in destination_moves:
+        for i, destination in enumerate(destination_moves):
+            progress('destinations', 10 + 75 * i / len(destination_moves))
             quantity = destination.internal_quantity
             reserved_quantity = consumed_quantities.get(('destination',
                     destination.id,), 0.0)
@@ -823,12 +1130,11 @@ class Reservation(Workflow, ModelSQL, ModelView):
             # Take in account stock from child locations
             location_id = destination.from_location.id
             if location_id not in child_locations:
-                child_locations[location_id] = Location.search([
-                        ('parent', 'child_of', [location_id]),
-                        ])
-            for location in child_locations[location_id]:
+                child_locations[location_id] = Location.get_descendant_ids(
+                    location_id)
+            for child_id in child_locations[location_id]:
                 # Create reservation from stock
-                key = (location.id, destination.product.id,)
+                key = (child_id, destination.product.id,)
                 stock_quantity = min(pbl.get(key, 0.0),
                     destination.internal_quantity)
                 if stock_quantity > 0.0:
@@ -836,7 +1142,7 @@ class Reservation(Workflow, ModelSQL, ModelView):
                     reservation = cls.get_reservation(None, destination,
                         reservation_quantity, destination.product.default_uom)
                     reservation.get_from_stock = True
-                    reservation.stock_location = location
+                    reservation.stock_location = Location(child_id)
                     pbl[key] -= reservation_quantity
                     to_create.append(reservation._save_values)
                     quantity -= reservation_quantity
@@ -864,14 +1170,13 @@ class Reservation(Workflow, ModelSQL, ModelView):
                     else default_warehouse_location)
                 if not purchase_location:
                     continue
-                if purchase_location not in child_locations:
-                    child_locations[purchase_location] = Location.search([
-                            ('parent', 'child_of', [purchase_location]),
-                            ])
+                if purchase_location.id not in child_locations:
+                    child_locations[purchase_location.id] = (
+                        Location.get_descendant_ids(purchase_location.id))
                 if purchase_line.product != destination.product:
                     continue
-                if (destination.from_location not in
-                        child_locations[purchase_location]):
+                if (destination.from_location.id not in
+                        child_locations[purchase_location.id]):
                     continue
                 key = ('purchase_line', purchase_line.id,)
                 consumed_quantity = consumed_quantities.get(key, 0.0)
@@ -911,14 +1216,13 @@ class Reservation(Workflow, ModelSQL, ModelView):
                     else default_warehouse_location)
                 if not purchase_location:
                     continue
-                if purchase_location not in child_locations:
-                    child_locations[purchase_location] = Location.search([
-                            ('parent', 'child_of', [purchase_location]),
-                            ])
+                if purchase_location.id not in child_locations:
+                    child_locations[purchase_location.id] = (
+                        Location.get_descendant_ids(purchase_location.id))
                 if purchase_request.product != destination.product:
                     continue
-                if (destination.from_location not in
-                        child_locations[purchase_location]):
+                if (destination.from_location.id not in
+                        child_locations[purchase_location.id]):
                     continue
                 key = ('purchase_request', purchase_request.id,)
                 consumed_quantity = consumed_quantities.get(key, 0.0)
@@ -953,6 +1257,7 @@ class Reservation(Workflow, ModelSQL, ModelView):
         # Create reservation for *remaining* quantities in source!!
         # That is:
         # * Source stock moves
+        progress('sources', 85)
         for source in cls.get_source_moves():
             key = ('source', source.id,)
             consumed_quantity = consumed_quantities.get(key, 0.0)
@@ -1023,9 +1328,16 @@ class Reservation(Workflow, ModelSQL, ModelView):
                 source_document=purchase_request)
             to_create.append(reservation._save_values)
 
-        if to_create:
-            return cls.create(to_create)
-        return []
+        progress('create', 90, 0)
+        reservations = []
+        with Transaction().set_context(skip_reservation_trace=True):
+            for sub_values in grouped_slice(to_create):
+                reservations.extend(cls.create(list(sub_values)))
+                created = len(reservations)
+                progress('create', 90 + 10 * created / len(to_create),
+                    created)
+        Trace.update_sales(sales | Trace.get_affected_sales(reservations))
+        return reservations
 
     @classmethod
     def get_purchase_requests(cls):
@@ -1219,6 +1531,319 @@ class Reservation(Workflow, ModelSQL, ModelView):
             product=product, quantity=quantity,
             uom=move_uom, location=location)
 
+    @classmethod
+    def _get_move_edges(cls):
+        '''
+        Return a query of the (source, destination) move pairs through which
+        goods flow: from the source to the destination of a reservation and
+        from the inputs to the outputs of a production.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        reservation = cls.__table__()
+        input_ = Move.__table__()
+        output = Move.__table__()
+        return Union(
+            reservation.select(
+                reservation.source.as_('source'),
+                reservation.destination.as_('destination'),
+                where=((reservation.source != None)
+                    & (reservation.destination != None))),
+            input_.join(output, condition=(
+                    input_.production_input == output.production_output)
+                ).select(
+                input_.id.as_('source'),
+                output.id.as_('destination')),
+            all_=True)
+
+    @classmethod
+    def get_move_chain(cls, start, forward=False):
+        '''
+        Return a query of the (key, move) pairs reachable from the (key, move)
+        pairs returned by the start query.
+        Moves are followed from destination to source or, if forward is set,
+        from source to destination.
+        '''
+        edges = cls._get_move_edges()
+        chain = With('key', 'move', recursive=True)
+        if forward:
+            from_, to = edges.source, edges.destination
+        else:
+            from_, to = edges.destination, edges.source
+        # UNION discards already visited pairs so cycles end the recursion
+        chain.query = start | chain.join(edges,
+            condition=from_ == chain.move).select(chain.key, to)
+        # The WITH clause is nested in a sub-query because sqlite3 of Python 2
+        # commits the transaction before statements not starting with SELECT
+        return chain.select(chain.key, chain.move, with_=[chain])
+
+
+class ReservationTrace(ModelSQL):
+    "Stock Reservation Trace"
+    __name__ = 'stock.reservation.trace'
+    sale = fields.Many2One('sale.sale', 'Sale', required=True, select=True,
+        ondelete='CASCADE')
+    reservation = fields.Many2One('stock.reservation', 'Reservation',
+        required=True, select=True, ondelete='CASCADE')
+    purchase_line = fields.Many2One('purchase.line', 'Purchase Line')
+    purchase = fields.Many2One('purchase.purchase', 'Purchase', select=True)
+    purchase_request = fields.Many2One('purchase.request',
+        'Purchase Request', select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReservationTrace, cls).__setup__()
+        cls._reservation_fields = ('source', 'destination', 'source_document')
+        cls._move_fields = ('shipment', 'origin', 'production_input',
+            'production_output')
+        # Traces are computed with SQL, only the cascades of the deleted
+        # sales, reservations and purchase documents change them
+        for method in ('create', 'write', 'delete', 'copy', 'import_data'):
+            cls.__rpc__.pop(method, None)
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        sale = Sale.__table__()
+
+        created = not TableHandler.table_exist(cls._table)
+
+        super(ReservationTrace, cls).__register__(module_name)
+
+        if created:
+            cursor.execute(*sale.select(sale.id))
+            cls.update_sales([s for s, in cursor.fetchall()])
+
+    @classmethod
+    def write(cls, *args):
+        with Transaction().set_context(_check_access=False):
+            super(ReservationTrace, cls).write(*args)
+
+    @classmethod
+    def delete(cls, traces):
+        with Transaction().set_context(_check_access=False):
+            super(ReservationTrace, cls).delete(traces)
+
+    @classmethod
+    def get_traced_sales(cls, reservations):
+        'Return the ids of the sales currently traced to the reservations'
+        trace = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        sales = set()
+        for sub_ids in grouped_slice([r.id for r in reservations]):
+            cursor.execute(*trace.select(trace.sale,
+                    where=reduce_ids(trace.reservation, sub_ids)))
+            sales.update(s for s, in cursor.fetchall())
+        return sales
+
+    @classmethod
+    def _get_forward_sales(cls, start):
+        '''
+        Return a dictionary with the ids of the sales whose shipments are
+        reached from the moves of the start query for each key
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Reservation = pool.get('stock.reservation')
+        SaleLine = pool.get('sale.line')
+        move = Move.__table__()
+        shipment_move = Move.__table__()
+        line = SaleLine.__table__()
+        cursor = Transaction().connection.cursor()
+        Integer = cls.id.sql_type().base
+
+        prefix = 'sale.line,'
+        chain = Reservation.get_move_chain(start, forward=True)
+        cursor.execute(*chain.join(move,
+                condition=move.id == chain.move
+                ).join(shipment_move,
+                condition=(shipment_move.shipment == move.shipment)
+                & Like(shipment_move.origin, prefix + '%')
+                ).join(line,
+                condition=line.id == Cast(Substring(shipment_move.origin,
+                        len(prefix) + 1), Integer)
+                ).select(chain.key, line.sale,
+                where=Like(move.shipment, 'stock.shipment.out%'),
+                group_by=[chain.key, line.sale]))
+        res = {}
+        for key, sale in cursor.fetchall():
+            res.setdefault(key, set()).add(sale)
+        return res
+
+    @classmethod
+    def get_affected_sales(cls, reservations):
+        '''
+        Return the ids of the sales whose shipments are reached from the
+        destination of the reservations
+        '''
+        pool = Pool()
+        Reservation = pool.get('stock.reservation')
+        reservation = Reservation.__table__()
+
+        sales = set()
+        for sub_ids in grouped_slice([r.id for r in reservations]):
+            start = reservation.select(reservation.id, reservation.destination,
+                where=reduce_ids(reservation.id, sub_ids)
+                & (reservation.destination != Null))
+            for sale_ids in cls._get_forward_sales(start).itervalues():
+                sales |= sale_ids
+        return sales
+
+    @classmethod
+    def get_move_sales(cls, moves):
+        '''
+        Return the ids of the sales traced to the reservations of the moves
+        or of their supplier shipments and of the sales whose shipments are
+        reached from the moves
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Reservation = pool.get('stock.reservation')
+        trace = cls.__table__()
+        reservation = Reservation.__table__()
+        move = Move.__table__()
+        source = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        sales = set()
+        for sub_ids in grouped_slice([m.id for m in moves]):
+            sub_ids = list(sub_ids)
+            cursor.execute(*trace.join(reservation,
+                    condition=reservation.id == trace.reservation
+                    ).select(trace.sale,
+                    where=reduce_ids(reservation.source, sub_ids)
+                    | reduce_ids(reservation.destination, sub_ids)))
+            sales.update(s for s, in cursor.fetchall())
+            cursor.execute(*trace.join(reservation,
+                    condition=reservation.id == trace.reservation
+                    ).join(source,
+                    condition=source.id == reservation.source
+                    ).join(move,
+                    condition=move.shipment == source.shipment
+                    ).select(trace.sale,
+                    where=reduce_ids(move.id, sub_ids)
+                    & (Like(move.shipment, 'stock.shipment.in,%')
+                        | Like(move.shipment, 'stock.shipment.in.return,%'))))
+            sales.update(s for s, in cursor.fetchall())
+            start = move.select(move.id, move.id,
+                where=reduce_ids(move.id, sub_ids))
+            for sale_ids in cls._get_forward_sales(start).itervalues():
+                sales |= sale_ids
+        return sales
+
+    @classmethod
+    def update_sales(cls, sale_ids):
+        'Compute again the traces of the sales'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        PurchaseLine = pool.get('purchase.line')
+        Reservation = pool.get('stock.reservation')
+        Sale = pool.get('sale.sale')
+        trace = cls.__table__()
+        reservation = Reservation.__table__()
+        source = Move.__table__()
+        shipment_move = Move.__table__()
+        purchase_line = PurchaseLine.__table__()
+        cursor = Transaction().connection.cursor()
+        Integer = cls.id.sql_type().base
+
+        prefix = 'purchase.line,'
+        line_id = Case(
+            (Like(source.origin, prefix + '%'),
+                Cast(Substring(source.origin, len(prefix) + 1), Integer)),
+            (reservation.source_document_model == 'purchase.line',
+                reservation.source_document_id),
+            else_=Null)
+        # Like Reservation.purchases, the purchase lines of the supplier
+        # shipment of the source are also traced, as for its inventory moves
+        shipment_line_id = Cast(
+            Substring(shipment_move.origin, len(prefix) + 1), Integer)
+        request_id = Case(
+            (reservation.source_document_model == 'purchase.request',
+                reservation.source_document_id),
+            else_=Null)
+        for sub_ids in grouped_slice(list(sale_ids)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*trace.delete(
+                    where=reduce_ids(trace.sale, sub_ids)))
+            chain = Reservation.get_move_chain(
+                Sale._get_shipment_moves_query(sub_ids))
+            query = chain.join(reservation,
+                condition=reservation.destination == chain.move
+                ).join(source, 'LEFT',
+                condition=source.id == reservation.source
+                ).join(shipment_move, 'LEFT',
+                condition=(shipment_move.shipment == source.shipment)
+                & (Like(source.shipment, 'stock.shipment.in,%')
+                    | Like(source.shipment, 'stock.shipment.in.return,%'))
+                & Like(shipment_move.origin, prefix + '%')
+                ).join(purchase_line, 'LEFT',
+                condition=(purchase_line.id == line_id)
+                | (purchase_line.id == shipment_line_id)
+                ).select(chain.key, reservation.id, purchase_line.id,
+                purchase_line.purchase, request_id,
+                Literal(Transaction().user), CurrentTimestamp(),
+                distinct=True)
+            cursor.execute(*trace.insert([trace.sale, trace.reservation,
+                        trace.purchase_line, trace.purchase,
+                        trace.purchase_request, trace.create_uid,
+                        trace.create_date], query))
+
+    @classmethod
+    def get_related(cls, records, from_name, to_name):
+        '''
+        Return a dictionary with the ids of the to_name records traced to
+        each of the records of the from_name field
+        '''
+        trace = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        from_column = getattr(trace, from_name)
+        to_column = getattr(trace, to_name)
+        res = dict((r.id, set()) for r in records)
+        for sub_ids in grouped_slice(res.keys()):
+            cursor.execute(*trace.select(from_column, to_column,
+                    where=reduce_ids(from_column, sub_ids)
+                    & (to_column != None),
+                    group_by=[from_column, to_column]))
+            for from_id, to_id in cursor.fetchall():
+                res[from_id].add(to_id)
+        return dict((k, list(v)) for k, v in res.iteritems())
+
+    @classmethod
+    def search_related(cls, from_name, to_name, clause):
+        '''
+        Return a domain on the from_name ids traced to the to_name records
+        that match the clause
+        '''
+        pool = Pool()
+        Target = pool.get(cls._fields[to_name].model_name)
+        trace = cls.__table__()
+        from_column = getattr(trace, from_name)
+        to_column = getattr(trace, to_name)
+
+        name, operator, value = clause[:3]
+        _, _, target_name = name.partition('.')
+        if not target_name and value is None and operator in ('=', '!='):
+            query = trace.select(from_column,
+                where=(from_column != Null) & (to_column != Null))
+            return [('id', 'not in' if operator == '=' else 'in', query)]
+        if not target_name:
+            # Like the relational fields, texts are matched on the rec_name
+            target_name = 'rec_name' if isinstance(value, basestring) else 'id'
+
+        negative = operator == '!=' or operator.startswith('not ')
+        if negative:
+            operator = '=' if operator == '!=' else operator[len('not '):]
+        targets = Target.search([
+                (target_name, operator, value) + tuple(clause[3:]),
+                ], order=[], query=True)
+        query = trace.select(from_column,
+            where=(from_column != Null) & to_column.in_(targets))
+        return [('id', 'not in' if negative else 'in', query)]
+
 
 class WaitReservationStart(ModelView):
     'Wait Reservations'
@@ -1238,12 +1863,298 @@ class WaitReservation(Wizard):
     def transition_wait_(self):
         Reservation = Pool().get('stock.reservation')
 
-        reservations = Reservation.browse(Transaction().context['active_ids'])
+        # Only draft reservations can be waited so avoid reading the others
+        reservations = Reservation.search([
+                ('id', 'in', Transaction().context['active_ids']),
+                ('state', '=', 'draft'),
+                ])
         Reservation.wait(reservations)
 
         return 'end'
 
 
+GENERATION_STATES = [
+    ('pending', 'Pending'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+    ]
+GENERATION_PHASES = [
+    (None, ''),
+    ('clean', 'Removing Draft Reservations'),
+    ('stock', 'Computing Stock'),
+    ('destinations', 'Reserving Outgoing Moves'),
+    ('sources', 'Reserving Remaining Supplies'),
+    ('create', 'Creating Reservations'),
+    ]
+
+
+class ReservationGeneration(ModelSQL, ModelView):
+    'Stock Reservation Generation'
+    __name__ = 'stock.reservation.generation'
+    state = fields.Selection(GENERATION_STATES, 'State', required=True,
+        readonly=True)
+    user = fields.Many2One('res.user', 'User', required=True, readonly=True,
+        help='The user the reservations are generated for.')
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    wait = fields.Boolean('Mark new reservations as waiting', readonly=True)
+    phase = fields.Selection(GENERATION_PHASES, 'Phase', readonly=True)
+    progress = fields.Float('Progress', digits=(16, 2), readonly=True)
+    progress_date = fields.DateTime('Last Progress', readonly=True)
+    created = fields.Integer('Created Reservations', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReservationGeneration, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._error_messages.update({
+                'running': ('Stock reservations are already being generated '
+                    '(generation "%s").'),
+                'cancelled': 'Cancelled by the user.',
+                'stale': 'No progress was reported for too long.',
+                })
+        cls._buttons.update({
+                'cancel': {
+                    'invisible': ~Eval('state').in_(['pending', 'running']),
+                    'icon': 'tryton-cancel',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_user():
+        return Transaction().user
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_wait():
+        return False
+
+    @staticmethod
+    def default_progress():
+        return 0.0
+
+    @staticmethod
+    def default_created():
+        return 0
+
+    @staticmethod
+    def _get_stale_date():
+        'Return the date before which a running generation is lost'
+        timeout = config.getint('stock_reservation', 'generation_timeout',
+            default=3600)
+        return datetime.now() - timedelta(seconds=timeout)
+
+    @classmethod
+    def _get_active_domain(cls):
+        return ['OR',
+            ('state', '=', 'pending'),
+            [
+                ('state', '=', 'running'),
+                ('progress_date', '>=', cls._get_stale_date()),
+                ],
+            ]
+
+    @classmethod
+    def get_active(cls):
+        'Return the generation pending or running, if any'
+        generations = cls.search(cls._get_active_domain(), limit=1)
+        if generations:
+            return generations[0]
+
+    @classmethod
+    def fail_stale(cls):
+        """
+        Set as failed the running generations which did not report progress
+        for longer than the generation_timeout of the configuration, as
+        their worker was killed or crashed.
+        """
+        generations = cls.search([
+                ('state', '=', 'running'),
+                ('progress_date', '<', cls._get_stale_date()),
+                ])
+        if generations:
+            cls.write(generations, {
+                    'state': 'failed',
+                    'error': cls.raise_user_error('stale',
+                        raise_exception=False),
+                    })
+
+    @classmethod
+    def enqueue(cls, wait=False):
+        """
+        Queue a new generation of reservations to be processed by the cron
+        for the current user and company.
+
+        Only one generation may be pending or running at a time.
+        """
+        transaction = Transaction()
+        transaction.database.lock(transaction.connection, cls._table)
+        cls.fail_stale()
+        active = cls.get_active()
+        if active:
+            cls.raise_user_error('running', (active.rec_name,))
+        generation, = cls.create([{
+                    'wait': wait,
+                    }])
+        return generation
+
+    @classmethod
+    def generate(cls):
+        'Queue a generation unless one is active and process the queue'
+        with Transaction().new_transaction():
+            if not cls.get_active():
+                cls.enqueue()
+        cls.process()
+
+    @classmethod
+    def process(cls):
+        """
+        Run the pending generations one after the other.
+
+        Each one is claimed, run and reported in its own transaction so the
+        progress is visible to the clients while it is computed.
+        """
+        while True:
+            claimed = cls._claim()
+            if not claimed:
+                break
+            cls._run(*claimed)
+
+    @classmethod
+    @ModelView.button
+    def cancel(cls, generations):
+        # A running generation stops at its next progress report and does
+        # not overwrite the failed state
+        generations = [g for g in generations
+            if g.state in ('pending', 'running')]
+        if generations:
+            cls.write(generations, {
+                    'state': 'failed',
+                    'error': cls.raise_user_error('cancelled',
+                        raise_exception=False),
+                    })
+
+    @classmethod
+    def _claim(cls):
+        """
+        Mark the first pending generation as running and return its id, wait,
+        user and company
+        """
+        with Transaction().new_transaction() as transaction:
+            transaction.database.lock(transaction.connection, cls._table)
+            cls.fail_stale()
+            generations = cls.search([
+                    ('state', '=', 'pending'),
+                    ], order=[('id', 'ASC')], limit=1)
+            if not generations:
+                return
+            generation, = generations
+            cls.write(generations, {
+                    'state': 'running',
+                    'phase': None,
+                    'progress': 0.0,
+                    'progress_date': datetime.now(),
+                    'created': 0,
+                    'error': None,
+                    })
+            return (generation.id, generation.wait, generation.user.id,
+                generation.company.id if generation.company else None)
+
+    @classmethod
+    def _update(cls, generation_id, values):
+        '''
+        Write values on the generation and commit them immediately if it is
+        still running. Return False if it was cancelled or set as stale.
+        '''
+        table = cls.__table__()
+        values = values.copy()
+        values['progress_date'] = values['write_date'] = datetime.now()
+        values['write_uid'] = Transaction().user
+        names = sorted(values)
+        with Transaction().new_transaction() as transaction:
+            cursor = transaction.connection.cursor()
+            # Check the state in the same statement so a concurrent cancel
+            # is never overwritten
+            cursor.execute(*table.update(
+                    [Column(table, n) for n in names],
+                    [values[n] for n in names],
+                    where=(table.id == generation_id)
+                    & (table.state == 'running')))
+            return cursor.rowcount > 0
+
+    @classmethod
+    def _get_progress(cls, generation_id):
+        """
+        Return the progress callback given to generate_reservations.
+
+        It only writes when the phase or the created reservations change or
+        the percentage increases by a full point to keep the number of
+        transactions low.
+        It raises GenerationAborted once the generation is no longer running.
+        """
+        last = {}
+
+        def progress(phase, percentage, created=None):
+            percentage = int(percentage)
+            if last.get('value') == (phase, percentage, created):
+                return
+            last['value'] = (phase, percentage, created)
+            values = {
+                'phase': phase,
+                'progress': percentage,
+                }
+            if created is not None:
+                values['created'] = created
+            if not cls._update(generation_id, values):
+                raise GenerationAborted(generation_id)
+        return progress
+
+    @classmethod
+    def _run(cls, generation_id, wait, user_id, company_id):
+        pool = Pool()
+        Reservation = pool.get('stock.reservation')
+        transaction = Transaction()
+
+        try:
+            # Generate as the user who queued it, not as the cron user
+            with transaction.set_user(user_id), \
+                    transaction.set_context(company=company_id), \
+                    transaction.new_transaction():
+                reservations = Reservation.generate_reservations(
+                    progress=cls._get_progress(generation_id))
+                if wait:
+                    Reservation.wait([r for r in reservations
+                            if r.reserve_type in ('on_time', 'in_stock',
+                                'delayed')])
+                created = len(reservations)
+        except GenerationAborted:
+            logger.info('Generation of stock reservations %s was aborted',
+                generation_id)
+            return
+        except Exception, exception:
+            logger.exception('Generation of stock reservations %s failed',
+                generation_id)
+            cls._update(generation_id, {
+                    'state': 'failed',
+                    'error': unicode(exception),
+                    })
+            return
+        cls._update(generation_id, {
+                'state': 'done',
+                'phase': None,
+                'progress': 100.0,
+                'created': created,
+                })
+
+
 class CreateReservationsStart(ModelView):
     'Create Reservations'
     __name__ = 'stock.create_reservations.start'
@@ -1256,26 +2167,63 @@ class CreateReservationsStart(ModelView):
         return False
 
 
+class CreateReservationsProgress(ModelView):
+    'Create Reservations Progress'
+    __name__ = 'stock.create_reservations.progress'
+    generation = fields.Many2One('stock.reservation.generation', 'Generation',
+        readonly=True)
+    state = fields.Selection(GENERATION_STATES, 'State', readonly=True)
+    phase = fields.Selection(GENERATION_PHASES, 'Phase', readonly=True)
+    progress = fields.Float('Progress', digits=(16, 2), readonly=True)
+    created = fields.Integer('Created Reservations', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+
 class CreateReservations(Wizard):
     'Create Reservations'
     __name__ = 'stock.create_reservations'
-    start = StateView('stock.create_reservations.start',
+    start = StateTransition()
+    ask = StateView('stock.create_reservations.start',
         'stock_reservation.create_reservations_start_view_form', [
             Button('Cancel', 'end', 'tryton-cancel'),
             Button('Create', 'create_', 'tryton-ok', default=True),
             ])
-    create_ = StateAction('stock_reservation.act_stock_reservation_type')
+    create_ = StateTransition()
+    progress = StateView('stock.create_reservations.progress',
+        'stock_reservation.create_reservations_progress_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+            Button('Refresh', 'progress', 'tryton-refresh', default=True),
+            Button('Open Reservations', 'open_', 'tryton-go-next'),
+            ])
+    open_ = StateAction('stock_reservation.act_stock_reservation_type')
 
-    def do_create_(self, action):
-        pool = Pool()
-        Reservation = pool.get('stock.reservation')
-        reservations = Reservation.generate_reservations()
-        if self.start.wait:
-            Reservation.wait([r for r in reservations
-                    if r.reserve_type in ('on_time', 'in_stock', 'delayed')])
-        return action, {}
+    def transition_start(self):
+        Generation = Pool().get('stock.reservation.generation')
+        # Follow the active generation instead of offering to start another
+        active = Generation.get_active()
+        if active:
+            self.progress.generation = active
+            return 'progress'
+        return 'ask'
 
     def transition_create_(self):
+        Generation = Pool().get('stock.reservation.generation')
+        self.progress.generation = Generation.enqueue(wait=self.ask.wait)
+        return 'progress'
+
+    def default_progress(self, fields):
+        Generation = Pool().get('stock.reservation.generation')
+        generation = Generation(self.progress.generation.id)
+        return {
+            'generation': generation.id,
+            'state': generation.state,
+            'phase': generation.phase,
+            'progress': generation.progress,
+            'created': generation.created,
+            'error': generation.error,
+            }
+
+    def transition_open_(self):
         return 'end'
 
 
@@ -1283,11 +2231,26 @@ class PrintReservationGraphStart(ModelView):
     'Print Reserve Graph'
     __name__ = 'stock.reservation.print_graph.start'
     level = fields.Integer('Level', required=True)
+    limit = fields.Integer('Node Limit', required=True,
+        help='Maximum number of reservations shown in the graph.')
+    format = fields.Selection([
+            ('svg', 'SVG'),
+            ('json', 'JSON'),
+            ('png', 'PNG (Graphviz)'),
+            ], 'Format', required=True)
 
     @staticmethod
     def default_level():
         return 1
 
+    @staticmethod
+    def default_limit():
+        return 500
+
+    @staticmethod
+    def default_format():
+        return 'svg'
+
 
 class PrintReservationGraph(Wizard):
     __name__ = 'stock.reservation.print_graph'
@@ -1307,17 +2270,39 @@ class PrintReservationGraph(Wizard):
             'id': Transaction().context.get('active_id'),
             'ids': Transaction().context.get('active_ids'),
             'level': self.start.level,
+            'limit': self.start.limit,
+            'format': self.start.format,
             }
 
 
-class ReservationGraph(Report):
+class ReservationGraph(WarningErrorMixin, Report):
     __name__ = 'stock.reservation.graph'
+    _render_cache = Cache('stock_reservation_graph.render', size_limit=100)
+    node_width = 180
+    node_height = 40
+    column_space = 60
+    row_space = 20
+
+    @classmethod
+    def __setup__(cls):
+        super(ReservationGraph, cls).__setup__()
+        cls._error_messages = {
+            'invalid_format': 'The graph format "%s" is not supported.',
+            'missing_graphviz': 'Graphviz "dot" is not available.',
+            'graphviz_failed': ('Graphviz "dot" failed or took more than '
+                '%s seconds.'),
+            }
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Translation = pool.get('ir.translation')
+        super(ReservationGraph, cls).__register__(module_name)
+        Translation.register_error_messages(cls, module_name)
 
     @classmethod
     def execute(cls, ids, data):
-        import pydot
         pool = Pool()
-        Reservation = pool.get('stock.reservation')
         ActionReport = pool.get('ir.action.report')
 
         action_report_ids = ActionReport.search([
@@ -1327,86 +2312,297 @@ class ReservationGraph(Report):
             raise Exception('Error', 'Report (%s) not find!' % cls.__name__)
         action_report = ActionReport(action_report_ids[0])
 
-        reserves = Reservation.browse(ids)
+        format_ = data.get('format', 'png')
+        if format_ not in ('svg', 'json', 'png'):
+            cls.raise_user_error('invalid_format', format_)
+        level = data.get('level', 1)
+        limit = data.get('limit', 500)
+        graph = cls.get_graph(ids, level, limit)
+        key = (tuple(sorted(ids)), level, limit, format_,
+            Transaction().language, cls.get_fingerprint(graph))
+        content = cls._render_cache.get(key)
+        if content is None:
+            cls.fill_nodes(graph)
+            content = getattr(cls, 'render_%s' % format_)(graph)
+            cls._render_cache.set(key, content)
+        return (format_, buffer(content), False, action_report.name)
+
+    @classmethod
+    def _get_links(cls, reverse=False):
+        '''
+        Return a query of the (source, target) reservation pairs where the
+        goods reserved by source are the ones reserved by target, either
+        through the same move or through a production
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Reservation = pool.get('stock.reservation')
+        reservation = Reservation.__table__()
+        next_ = Reservation.__table__()
+        input_ = Move.__table__()
+        output = Move.__table__()
+        production_reservation = Reservation.__table__()
+        production_next = Reservation.__table__()
+
+        def columns(source, target):
+            if reverse:
+                source, target = target, source
+            return source.as_('source'), target.as_('target')
+
+        return Union(
+            reservation.join(next_,
+                condition=next_.source == reservation.destination
+                ).select(*columns(reservation.id, next_.id)),
+            production_reservation.join(input_,
+                condition=input_.id == production_reservation.destination
+                ).join(output,
+                condition=output.production_output == input_.production_input
+                ).join(production_next,
+                condition=production_next.source == output.id
+                ).select(*columns(production_reservation.id,
+                    production_next.id)),
+            all_=True)
+
+    @classmethod
+    def get_graph(cls, ids, level, limit):
+        '''
+        Return a dictionary with the levels and edges of the reservations
+        reached from ids in up to level links, with at most limit nodes
+        '''
+        pool = Pool()
+        Reservation = pool.get('stock.reservation')
+        reservation = Reservation.__table__()
+        cursor = Transaction().connection.cursor()
 
-        graph = pydot.Dot(fontsize="8")
-        graph.set('center', '1')
-        graph.set('ratio', 'auto')
-        cls.fill_graph(reserves, graph, level=data['level'])
-        data = graph.create(prog='dot', format='png')
-        return ('png', buffer(data), False, action_report.name)
+        links = Union(cls._get_links(), cls._get_links(reverse=True),
+            all_=True)
+        # The neighborhood is expanded one level per query and each query
+        # reads only the nodes still allowed so the limit bounds the work
+        cursor.execute(*reservation.select(reservation.id,
+                where=reduce_ids(reservation.id, ids),
+                order_by=[reservation.id],
+                limit=limit + 1))
+        frontier = [r for r, in cursor.fetchall()]
+        truncated = len(frontier) > limit
+        frontier = frontier[:limit]
+        levels = dict((r, 0) for r in frontier)
+        for depth in xrange(1, level + 1):
+            if not frontier or truncated:
+                break
+            remaining = limit - len(levels)
+            found = set()
+            for sub_ids in grouped_slice(frontier):
+                # Some targets may be already visited so read enough of them
+                cursor.execute(*links.select(links.target,
+                        where=reduce_ids(links.source, list(sub_ids)),
+                        group_by=[links.target],
+                        order_by=[links.target],
+                        limit=len(levels) + remaining + 1))
+                found.update(t for t, in cursor.fetchall()
+                    if t not in levels)
+                if len(found) > remaining:
+                    break
+            found = sorted(found)
+            truncated = len(found) > remaining
+            frontier = found[:remaining]
+            levels.update((r, depth) for r in frontier)
+
+        edges = []
+        node_ids = levels.keys()
+        if node_ids:
+            directed = cls._get_links()
+            cursor.execute(*directed.select(directed.source, directed.target,
+                    where=reduce_ids(directed.source, node_ids)
+                    & reduce_ids(directed.target, node_ids)))
+            edges = sorted(set(cursor.fetchall()))
+        return {
+            'levels': levels,
+            'edges': edges,
+            'truncated': truncated,
+            }
 
     @classmethod
-    def fill_graph(cls, reservations, graph, level=1, edges_data=None):
+    def get_fingerprint(cls, graph):
         '''
-        Fills a pydot graph with a reserves.
+        Return a fingerprint of the graph that changes when its reservations
+        are modified
         '''
-        import pydot
         pool = Pool()
         Reservation = pool.get('stock.reservation')
+        reservation = Reservation.__table__()
+        cursor = Transaction().connection.cursor()
 
-        if not edges_data:
-            edges_data = {}
+        dates = []
+        for sub_ids in grouped_slice(sorted(graph['levels'])):
+            cursor.execute(*reservation.select(reservation.id,
+                    Coalesce(reservation.write_date, reservation.create_date),
+                    where=reduce_ids(reservation.id, sub_ids),
+                    order_by=[reservation.id]))
+            dates.extend(cursor.fetchall())
+        return hashlib.sha1(repr((sorted(graph['levels'].items()),
+                    graph['edges'], graph['truncated'], dates))).hexdigest()
 
-        if level > 0:
-            sources = set()
-            destinations = set()
-            for reservation in reservations:
-                if reservation.source:
-                    move = reservation.source
-                    sources.add(move)
-                    edges_data[move] = reservation
-                    if move.production_output:
-                        for input in move.production_output.inputs:
-                            sources.add(input)
-                            edges_data[input] = reservation
-                if reservation.destination:
-                    move = reservation.destination
-                    destinations.add(move)
-                    edges_data[move] = reservation
-                    if move.production_input:
-                        for output in move.production_input.outputs:
-                            sources.add(output)
-                            edges_data[output] = reservation
-            sub_reserves = Reservation.search([
-                    ['OR',
-                        ('source', 'in', list(sources)),
-                        ('destination', 'in', list(destinations)),
-                        ],
-                    ])
-            if sub_reserves:
-                cls.fill_graph(sub_reserves, graph, level - 1, edges_data)
+    @classmethod
+    def fill_nodes(cls, graph):
+        'Add the nodes with the values to render to the graph'
+        pool = Pool()
+        Reservation = pool.get('stock.reservation')
+        levels = graph['levels']
 
-        for reserve in reservations:
-            label = '"{' + reserve.rec_name + '\\n'
-            #    label += '|'
-            # TODO: Determine which info to show on lables.
-#            label += reserve.reserve_type
-#            label += '\l'
-#            if reserve.source_document:
-#                label += reserve.source_document.rec_name
-#                label += '\l'
-#            if reserve.destination_document:
-#                label += reserve.destination_document.rec_name
-#                label += '\l'
-            label += '}"'
-            node_name = str(reserve.id)
-            node = pydot.Node(node_name, shape='record', label=label)
-            graph.add_node(node)
-
-            if reserve.source in edges_data:
-                edge = pydot.Edge(
-                    str(edges_data[reserve.source].id),
-                    str(reserve.id),
-                    )
-                graph.add_edge(edge)
-
-            if reserve.destination in edges_data:
-                edge = pydot.Edge(
-                    str(edges_data[reserve.destination].id),
-                    str(reserve.id),
-                    )
-                graph.add_edge(edge)
+        nodes = []
+        for values in Reservation.read(levels.keys(), ['rec_name', 'state']):
+            values['level'] = levels[values['id']]
+            nodes.append(values)
+        nodes.sort(key=lambda n: (n['level'], n['id']))
+        graph['nodes'] = nodes
+
+    @classmethod
+    def render_json(cls, graph):
+        return json.dumps({
+                'nodes': [{
+                        'id': n['id'],
+                        'label': n['rec_name'],
+                        'state': n['state'],
+                        'level': n['level'],
+                        } for n in graph['nodes']],
+                'edges': [{
+                        'source': s,
+                        'target': t,
+                        } for s, t in graph['edges']],
+                'truncated': graph['truncated'],
+                }, sort_keys=True)
+
+    @classmethod
+    def _get_ranks(cls, graph):
+        'Return the column of each node, following the edges direction'
+        ranks = dict((n['id'], 0) for n in graph['nodes'])
+        # Bounded relaxation so cycles do not loop forever
+        for _ in xrange(len(ranks)):
+            changed = False
+            for source, target in graph['edges']:
+                if ranks[target] < ranks[source] + 1 <= len(ranks):
+                    ranks[target] = ranks[source] + 1
+                    changed = True
+            if not changed:
+                break
+        return ranks
+
+    @classmethod
+    def render_svg(cls, graph):
+        ranks = cls._get_ranks(graph)
+        positions = {}
+        rows = defaultdict(int)
+        for node in graph['nodes']:
+            column = ranks[node['id']]
+            positions[node['id']] = (
+                column * (cls.node_width + cls.column_space),
+                rows[column] * (cls.node_height + cls.row_space))
+            rows[column] += 1
+        width = ((max(ranks.values() or [0]) + 1)
+            * (cls.node_width + cls.column_space))
+        height = max(rows.values() or [0]) * (cls.node_height + cls.row_space)
+
+        lines = [
+            '<svg xmlns="http://www.w3.org/2000/svg" '
+            'width="%d" height="%d" font-family="sans-serif" '
+            'font-size="10">' % (width, height + cls.row_space),
+            '<defs><marker id="arrow" markerWidth="8" markerHeight="8" '
+            'refX="8" refY="4" orient="auto">'
+            '<path d="M0,0 L8,4 L0,8 z"/></marker></defs>',
+            ]
+        for source, target in graph['edges']:
+            x1, y1 = positions[source]
+            x2, y2 = positions[target]
+            lines.append('<line x1="%d" y1="%d" x2="%d" y2="%d" '
+                'stroke="black" marker-end="url(#arrow)"/>' % (
+                    x1 + cls.node_width, y1 + cls.node_height // 2,
+                    x2, y2 + cls.node_height // 2))
+        for node in graph['nodes']:
+            x, y = positions[node['id']]
+            lines.append('<g><rect x="%d" y="%d" width="%d" height="%d" '
+                'fill="white" stroke="black"/>' % (
+                    x, y, cls.node_width, cls.node_height))
+            lines.append('<text x="%d" y="%d">%s</text>' % (x + 4, y + 16,
+                    escape(node['rec_name'])))
+            lines.append('<text x="%d" y="%d">%s</text></g>' % (x + 4,
+                    y + 32, escape(node['state'])))
+        lines.append('</svg>')
+        return '\n'.join(lines).encode('utf-8')
+
+    @classmethod
+    def render_dot_source(cls, graph):
+        def quote(value):
+            return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+        lines = ['digraph {', 'graph [fontsize=8, center=1, ratio=auto];']
+        for node in graph['nodes']:
+            lines.append('%d [shape=box, label=%s];' % (node['id'],
+                    quote(node['rec_name'])))
+        for source, target in graph['edges']:
+            lines.append('%d -> %d;' % (source, target))
+        lines.append('}')
+        return '\n'.join(lines).encode('utf-8')
+
+    @classmethod
+    def render_png(cls, graph):
+        timeout = config.getint('stock_reservation', 'graph_timeout',
+            default=30)
+        try:
+            process = subprocess.Popen(['dot', '-Tpng'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        except OSError:
+            cls.raise_user_error('missing_graphviz')
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+        try:
+            content, _ = process.communicate(cls.render_dot_source(graph))
+        finally:
+            timer.cancel()
+        if process.returncode != 0:
+            cls.raise_user_error('graphviz_failed', timeout)
+        return content
+
+
+class Location:
+    __name__ = 'stock.location'
+    _descendants_cache = Cache('stock.location.descendants', context=False)
+
+    @classmethod
+    def get_descendant_ids(cls, location_id):
+        """
+        Return the ids of location_id and its children as returned by a
+        child_of search.
+
+        The result is shared between transactions until a location is
+        created, modified or deleted.
+        """
+        key = (location_id, Transaction().language)
+        location_ids = cls._descendants_cache.get(key)
+        if location_ids is None:
+            location_ids = tuple(l.id for l in cls.search([
+                        ('parent', 'child_of', [location_id]),
+                        ]))
+            cls._descendants_cache.set(key, location_ids)
+        return location_ids
+
+    @classmethod
+    def create(cls, vlist):
+        locations = super(Location, cls).create(vlist)
+        cls._descendants_cache.clear()
+        return locations
+
+    @classmethod
+    def write(cls, *args):
+        super(Location, cls).write(*args)
+        # The order of the children depends on the name and the tree on the
+        # parent and active fields so any change resets it
+        cls._descendants_cache.clear()
+
+    @classmethod
+    def delete(cls, locations):
+        super(Location, cls).delete(locations)
+        cls._descendants_cache.clear()
 
 
 class Move:
@@ -1438,6 +2634,8 @@ class Move:
             })
         cls.reserve_non_writable_fields = ('quantity', 'from_location',
                         'to_location')
+        cls.reserve_document_fields = ('shipment', 'production_input',
+            'production_output')
 
     def get_reserved_quantity(self, name):
         if not self.reserves_destination:
@@ -1589,10 +2787,22 @@ class Move:
                     })
         Reservation.fail(source_reservations + destination_reservations)
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Trace = pool.get('stock.reservation.trace')
+        moves = super(Move, cls).create(vlist)
+        to_trace = [m for m, v in zip(moves, vlist)
+            if any(v.get(f) for f in Trace._move_fields)]
+        if to_trace:
+            Trace.update_sales(Trace.get_move_sales(to_trace))
+        return moves
+
     @classmethod
     def write(cls, *args):
         pool = Pool()
         Reservation = pool.get('stock.reservation')
+        Trace = pool.get('stock.reservation.trace')
 
         if not Transaction().context.get('ignore_reserve_warnings', False):
             actions = iter(args)
@@ -1624,12 +2834,35 @@ class Move:
                         cls.raise_user_warning('%s.write' % set(warning_ids),
                             'write_reserved_move')
                         Reservation.delete(reserves)
+
+        actions = iter(args)
+        moves = []
+        to_trace = []
+        for records, values in zip(actions, actions):
+            if set(values.keys()) & set(cls.reserve_document_fields):
+                moves.extend(records)
+            if set(values.keys()) & set(Trace._move_fields):
+                to_trace.extend(records)
+        reserves = []
+        if moves:
+            reserves = Reservation.search([
+                    ('destination', 'in', [m.id for m in moves]),
+                    ])
+        sales = Trace.get_move_sales(to_trace)
+
         super(Move, cls).write(*args)
 
+        if reserves:
+            Reservation.update_destination_document(reserves)
+        if to_trace:
+            sales |= Trace.get_move_sales(to_trace)
+            Trace.update_sales(sales)
+
     @classmethod
     def delete(cls, moves):
         pool = Pool()
         Reservation = pool.get('stock.reservation')
+        Trace = pool.get('stock.reservation.trace')
         if not Transaction().context.get('ignore_reserve_warnings', False):
             if Reservation.search([
                         ['OR',
@@ -1641,7 +2874,12 @@ class Move:
                     for m in moves]
                 cls.raise_user_warning('%s.delete' % set(warning_ids),
                     'delete_reserved_move')
-        super(Move, cls).delete(moves)
+        # The reservations of the moves are deleted in cascade so their
+        # traced sales are computed again only once the moves are deleted
+        sales = Trace.get_move_sales(moves)
+        with Transaction().set_context(skip_reservation_trace=True):
+            super(Move, cls).delete(moves)
+        Trace.update_sales(sales)
 
     def _get_reserved_moves_warning_id(self):
         pool = Pool()
@@ -1699,11 +2937,10 @@ class ReserveRelatedMixin:
                 ('pending', 'Pending'),
                 ('delayed', 'Delayed'),
                 ('on_time', 'On Time'),
-                ], 'Reserve State'), 'get_reserve_state',
+                ], 'Reserve State'), 'get_reserve_values',
         searcher='search_reserve_state')
     reserve_day_difference = fields.Function(fields.Integer('Day Difference'),
-        'get_reserve_day_difference',
-        searcher='search_reserve_day_difference')
+        'get_reserve_values', searcher='search_reserve_day_difference')
 
     def get_reserves(self, name):
         pool = Pool()
@@ -1712,51 +2949,84 @@ class ReserveRelatedMixin:
         return [x.id for x in Reservation.search([
                     ('destination_document', '=', str(self))])]
 
-    def get_reserve_state(self, name):
-        if not self.reserves:
-            return 'none'
-        if any(x.reserve_type == 'pending' for x in self.reserves):
-            return 'pending'
-        if any(x.reserve_type == 'delayed' for x in self.reserves):
-            return 'delayed'
-        if all((x.reserve_type == 'on_time' or x.reserve_type == 'in_stock')
-                for x in self.reserves):
-            return 'on_time'
-        return 'none'
-
-    def get_reserve_day_difference(self, name):
-        reserves_difference = [x.day_difference for x in self.reserves
-            if x.day_difference]
-        if not reserves_difference:
-            return
-        return max(reserves_difference)
-
     @classmethod
-    def search_reserve_state(cls, name, clause):
+    def _get_reserve_query(cls):
+        '''
+        Return the table of the model left joined to its reservations and
+        their moves, and the aggregated columns of the reserve fields
+        '''
         pool = Pool()
+        Move = pool.get('stock.move')
         Reservation = pool.get('stock.reservation')
+        table = cls.__table__()
+        reservation = Reservation.__table__()
+        source = Move.__table__()
+        destination = Move.__table__()
+        Char = Reservation.destination_document.sql_type().base
+
+        join = table.join(reservation, 'LEFT',
+            condition=reservation.destination_document == Concat(
+                Literal(cls.__name__ + ','), Cast(table.id, Char))
+            ).join(source, 'LEFT',
+            condition=reservation.source == source.id
+            ).join(destination, 'LEFT',
+            condition=reservation.destination == destination.id)
+
+        reserve_type = Reservation._get_reserve_type_sql(reservation, source,
+            destination)
+        day_difference = Reservation._get_day_difference_sql(reservation,
+            source, destination)
+
+        def any_(condition):
+            return Max(Case((condition, 1), else_=0)) == 1
+
+        columns = {
+            'reserve_state': Case(
+                (Count(reservation.id) == 0, Literal('none')),
+                (any_(reserve_type == 'pending'), Literal('pending')),
+                (any_(reserve_type == 'delayed'), Literal('delayed')),
+                (Min(Case((reserve_type.in_(['on_time', 'in_stock']), 1),
+                            else_=0)) == 1, Literal('on_time')),
+                else_=Literal('none')),
+            'reserve_day_difference': Max(Case(
+                    (day_difference != 0, day_difference), else_=Null)),
+            }
+        return table, join, columns
 
-        clause[0] = 'reserve_type'
-        if clause[2] == 'on_time':
-            clause[1] = 'in' if clause[1] == '=' else 'not in'
-            clause[2] = ['on_time', 'in_stock']
-        reserves = Reservation.search([
-                ('destination_document', 'like', cls.__name__ + ',%'),
-                clause,
-                ])
-        return [('id', 'in', [x.destination_document.id for x in reserves])]
+    @classmethod
+    def get_reserve_values(cls, records, names):
+        cursor = Transaction().connection.cursor()
+        table, join, columns = cls._get_reserve_query()
+
+        res = dict((n, {}) for n in names)
+        for sub_ids in grouped_slice([r.id for r in records]):
+            cursor.execute(*join.select(table.id,
+                    *[columns[n] for n in names],
+                    where=reduce_ids(table.id, sub_ids),
+                    group_by=[table.id]))
+            for row in cursor.fetchall():
+                for name, value in zip(names, row[1:]):
+                    res[name][row[0]] = value
+        return res
 
     @classmethod
-    def search_reserve_day_difference(cls, name, clause):
-        pool = Pool()
-        Reservation = pool.get('stock.reservation')
+    def _search_reserve_column(cls, name, clause):
+        table, join, columns = cls._get_reserve_query()
+        Operator = fields.SQL_OPERATORS[clause[1]]
+        value = clause[2]
+        if value is None:
+            value = Null
+        query = join.select(table.id, group_by=[table.id],
+            having=Operator(columns[name], value))
+        return [('id', 'in', query)]
 
-        clause[0] = 'day_difference'
-        reserves = Reservation.search([
-                ('destination_document', 'like', cls.__name__ + ',%'),
-                clause,
-                ])
-        return [('id', 'in', [x.destination_document.id for x in reserves])]
+    @classmethod
+    def search_reserve_state(cls, name, clause):
+        return cls._search_reserve_column('reserve_state', clause)
+
+    @classmethod
+    def search_reserve_day_difference(cls, name, clause):
+        return cls._search_reserve_column('reserve_day_difference', clause)
 
 
 class Production(ReserveRelatedMixin):
@@ -1775,82 +3045,90 @@ class Production(ReserveRelatedMixin):
                 })
 
     @classmethod
-    def get_ready_to_assign(cls, productions, name):
+    def _get_not_ready_to_assign_query(cls, production_ids=None):
+        '''
+        Return a query of the productions with an input product whose
+        quantity is not reserved from stock up to the rounding of the
+        reservation UoM
+        '''
         pool = Pool()
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
         Reservation = pool.get('stock.reservation')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        input_ = Move.__table__()
+        destination = Move.__table__()
+        reservation = Reservation.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        uom = Uom.__table__()
+        default_uom = Uom.__table__()
+        required_product = Product.__table__()
+        required_template = Template.__table__()
+        required_uom = Uom.__table__()
+
+        input_where = input_.production_input != Null
+        destination_where = destination.production_input != Null
+        if production_ids is not None:
+            input_where &= reduce_ids(input_.production_input, production_ids)
+            destination_where &= reduce_ids(destination.production_input,
+                production_ids)
+
+        required = input_.select(input_.production_input.as_('production'),
+            input_.product.as_('product'),
+            Sum(input_.internal_quantity).as_('quantity'),
+            where=input_where,
+            group_by=[input_.production_input, input_.product])
+        reserved = reservation.join(destination,
+            condition=reservation.destination == destination.id
+            ).join(product, condition=reservation.product == product.id
+            ).join(template, condition=product.template == template.id
+            ).join(uom, condition=reservation.uom == uom.id
+            ).join(default_uom,
+            condition=template.default_uom == default_uom.id
+            ).select(destination.production_input.as_('production'),
+            reservation.product.as_('product'),
+            Sum(reservation.quantity * uom.factor / default_uom.factor
+                ).as_('quantity'),
+            Max(uom.rounding * uom.factor / default_uom.factor
+                ).as_('rounding'),
+            where=destination_where & reservation.get_from_stock,
+            group_by=[destination.production_input, reservation.product])
+        return required.join(reserved, 'LEFT',
+            condition=(required.production == reserved.production)
+            & (required.product == reserved.product)
+            ).join(required_product,
+            condition=required.product == required_product.id
+            ).join(required_template,
+            condition=required_product.template == required_template.id
+            ).join(required_uom,
+            condition=required_template.default_uom == required_uom.id
+            ).select(required.production,
+            # The remaining quantity is tolerated up to the rounding of the
+            # reservation UoM, or of the default UoM when nothing is reserved
+            where=(required.quantity - Coalesce(reserved.quantity, 0)
+                > Coalesce(reserved.rounding, required_uom.rounding)),
+            group_by=[required.production])
 
-        productions_inputs = {}
-        for production in productions:
-            product_quantities = {}
-            for input in production.inputs:
-                qty = product_quantities.setdefault(input.product, 0.0)
-                product_quantities[input.product] = (qty +
-                    input.internal_quantity)
-            productions_inputs[production] = product_quantities
-
-        reserves = Reservation.search([
-                ('destination', 'in',
-                    [m for p in productions for m in p.inputs]),
-                ])
-        for reserve in reserves:
-            if (not reserve.destination and not
-                    reserve.destination.production_input):
-                # It shouldn't happen
-                continue
-            if reserve.reserve_type == 'in_stock':
-                production = reserve.destination.production_input
-                qty = productions_inputs[production].get(reserve.product, None)
-                if qty is None:
-                    # already removed
-                    continue
-                qty -= reserve.internal_quantity
-                if qty <= reserve.uom.rounding:
-                    del productions_inputs[production][reserve.product]
-                else:
-                    productions_inputs[production][reserve.product] = qty
+    @classmethod
+    def get_ready_to_assign(cls, productions, name):
+        cursor = Transaction().connection.cursor()
 
-        res = {}
-        for production, value in productions_inputs.iteritems():
-            res[production.id] = not bool(value)
-        return res
+        not_ready = set()
+        for sub_ids in grouped_slice([p.id for p in productions]):
+            cursor.execute(*cls._get_not_ready_to_assign_query(
+                    list(sub_ids)))
+            not_ready.update(p for p, in cursor.fetchall())
+        return dict((p.id, p.id not in not_ready) for p in productions)
 
     @classmethod
     def search_ready_to_assign(cls, name, clause):
-        # TODO: apply changes done in get_ready_to_assign
-        pool = Pool()
-        Reservation = pool.get('stock.reservation')
-
-        reserves = Reservation.search([
-                ('reserve_type', '=', 'in_stock'),
-                ])
-
-        productions_inputs = {}
-        productions = set()
-        for reserve in reserves:
-            production = (reserve.destination and
-                reserve.destination.production_input)
-            if not production:
-                continue
-            if not production in productions_inputs:
-                product_quantities = {}
-                for input in production.inputs:
-                    qty = product_quantities.setdefault(input.product, 0.0)
-                    product_quantities[input.product] = (qty +
-                        input.internal_quantity)
-                productions_inputs[production] = product_quantities
-            product_quantities = productions_inputs[production]
-            qty = product_quantities.setdefault(reserve.product, 0.0)
-            qty -= reserve.internal_quantity
-            if qty <= 0.0:
-                del product_quantities[reserve.product]
-            else:
-                product_quantities[reserve.product] = qty
-            if not product_quantities:
-                productions.add(production)
-            productions_inputs[production] = product_quantities
-
-        operator = 'in' if clause[2] else 'not in'
-        return [('id', operator, [x.id for x in productions])]
+        ready = bool(clause[2])
+        if clause[1] == '!=':
+            ready = not ready
+        query = cls._get_not_ready_to_assign_query()
+        return [('id', 'not in' if ready else 'in', query)]
 
     @classmethod
     def delete(cls, productions):
@@ -1880,84 +3158,86 @@ class Sale(ReserveRelatedMixin):
 
     purchases = fields.Function(fields.One2Many('purchase.purchase', None,
             'Purchases'),
-        #'get_purchases_and_requests', searcher='search_purchases')
-        'get_purchases', searcher='search_purchases')
+        'get_purchases_and_requests', searcher='search_purchases')
 
     purchase_requests = fields.Function(fields.One2Many('purchase.request',
             None, 'Purchase Requests'),
-        #'get_purchases_and_requests', searcher='search_purchase_requests')
-        'get_purchase_requests', searcher='search_purchase_requests')
+        'get_purchases_and_requests', searcher='search_purchase_requests')
 
     def get_recursive_reservations_generator(self):
-        """Generator version"""
+        '''
+        Yield the reservations that supply the shipments of the sale level by
+        level, following reservations and productions backwards.
+        Each level is read by chunks of moves only once the reservations of
+        the previous chunk are consumed.
+        '''
         pool = Pool()
-        Move = pool.get('stock.move')
         Reservation = pool.get('stock.reservation')
+        edges = Reservation._get_move_edges()
+        cursor = Transaction().connection.cursor()
 
-        def get_recursive_moves(moves, processed_moves=None):
-            if not moves:
-                return
-            if processed_moves is None:
-                processed_moves = set()
-
-            reservations = Reservation.search([
-                    ('destination', 'in', moves),
-                    ])
-
-            new_moves = set()
-            for reservation in reservations:
-                yield reservation
-                if reservation.source and isinstance(reservation.source, Move):
-                    new_moves.add(reservation.source)
+        cursor.execute(*self._get_shipment_moves_query([self.id]))
+        frontier = set(m for _, m in cursor.fetchall())
+        visited = set(frontier)
+        while frontier:
+            next_frontier = set()
+            for sub_ids in grouped_slice(sorted(frontier)):
+                sub_ids = list(sub_ids)
+                for reservation in Reservation.search([
+                            ('destination', 'in', sub_ids),
+                            ], order=[('id', 'ASC')]):
+                    yield reservation
+                cursor.execute(*edges.select(edges.source,
+                        where=reduce_ids(edges.destination, sub_ids)))
+                next_frontier.update(m for m, in cursor.fetchall())
+            frontier = next_frontier - visited
+            visited |= frontier
 
-            for move in moves:
-                if move.id in processed_moves:
-                    continue
-                if move.production_output:
-                    new_moves |= set(move.production_output.inputs)
-                processed_moves.add(move.id)
+    @classmethod
+    def _get_shipment_moves_query(cls, sale_ids):
+        'Return a query of the (sale, move) pairs of the sales shipments'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        SaleLine = pool.get('sale.line')
+        line = SaleLine.__table__()
+        line_move = Move.__table__()
+        move = Move.__table__()
+        Char = cls.state.sql_type().base
+        return line.join(line_move, condition=(
+                line_move.origin == Concat(Literal('sale.line,'),
+                    Cast(line.id, Char)))
+            ).join(move, condition=move.shipment == line_move.shipment
+            ).select(line.sale, move.id,
+            where=reduce_ids(line.sale, sale_ids)
+            & Like(line_move.shipment, 'stock.shipment.out%'))
 
-            get_recursive_moves(list(new_moves), processed_moves)
+    @classmethod
+    def _get_recursive_reservations(cls, sales):
+        '''
+        Return a dictionary with the ids of the reservations that supply the
+        shipments of each sale, following reservations and productions
+        '''
+        pool = Pool()
+        Reservation = pool.get('stock.reservation')
+        reservation = Reservation.__table__()
+        cursor = Transaction().connection.cursor()
 
-        moves = []
-        for shipment in self.shipments + self.shipment_returns:
-            moves += shipment.inventory_moves
-        for reservation in get_recursive_moves(moves):
-            yield reservation
+        res = dict((s.id, []) for s in sales)
+        for sub_ids in grouped_slice(res.keys()):
+            chain = Reservation.get_move_chain(
+                cls._get_shipment_moves_query(sub_ids))
+            cursor.execute(*chain.join(reservation,
+                    condition=reservation.destination == chain.move
+                    ).select(chain.key, reservation.id))
+            for sale_id, reservation_id in cursor.fetchall():
+                res[sale_id].append(reservation_id)
+        return res
 
     def get_recursive_reservations(self):
         pool = Pool()
-        Move = pool.get('stock.move')
         Reservation = pool.get('stock.reservation')
-
-        def get_recursive_moves(moves, processed_moves=None):
-            if not moves:
-                return []
-            if processed_moves is None:
-                processed_moves = set()
-
-            reservations = Reservation.search([
-                    ('destination', 'in', moves),
-                    ])
-            new_moves = set([r.source for r in reservations
-                    if r.source and isinstance(r.source, Move)])
-            for move in moves:
-                if move.id in processed_moves:
-                    continue
-                if move.production_output:
-                    new_moves |= set(move.production_output.inputs)
-                processed_moves.add(move.id)
-
-            reservations += get_recursive_moves(list(new_moves),
-                processed_moves)
-
-            return reservations
-
-        moves = []
-        for shipment in self.shipments + self.shipment_returns:
-            moves += shipment.inventory_moves
-        res = get_recursive_moves(moves)
-        return res
+        return Reservation.browse(
+            self._get_recursive_reservations([self])[self.id])
 
     @classmethod
     def get_purchases_and_requests(cls, sales, names):
@@ -1965,98 +3245,77 @@ class Sale(ReserveRelatedMixin):
         PurchaseLine = pool.get('purchase.line')
         Request = pool.get('purchase.request')
         SaleLine = pool.get('sale.line')
+        Trace = pool.get('stock.reservation.trace')
+        trace = Trace.__table__()
+        cursor = Transaction().connection.cursor()
 
-        res = {}
-        for fname in names:
-            res[fname] = {}
-
-        for sale in sales:
-            purchases = set()
-            requests = set()
-            for reservation in sale.get_recursive_reservations_generator():
-                if 'purchases' in names:
-                    if reservation.source and reservation.source.origin:
-                        origin = reservation.source.origin
-                        if isinstance(origin, PurchaseLine):
-                            purchases.add(origin.purchase)
-                    elif reservation.source_document and isinstance(
-                            reservation.source_document, PurchaseLine):
-                        purchases.add(reservation.source_document.purchase)
-                if ('purchase_requests' in names
-                        and reservation.source_document
-                        and isinstance(reservation.source_document, Request)):
-                    requests.add(reservation.source_document)
-            # support sale_supply(_drop_shipment)
-            if hasattr(SaleLine, 'purchase_request'):
-                for line in sale.lines:
-                    if ('purchases' in names and line.purchase_request
-                            and line.purchase_request.purchase):
-                        purchases.add(line.purchase_request.purchase)
-                    if 'purchase_requests' in names and line.purchase_request:
-                        requests.add(line.purchase_request)
-            if 'purchases' in names:
-                res['purchases'][sale.id] = [p.id for p in purchases]
-            if 'purchase_requests' in names:
-                res['purchase_requests'][sale.id] = [r.id for r in requests]
-        return res
-
-    def get_purchases(self, name):
-        pool = Pool()
-        PurchaseLine = pool.get('purchase.line')
-        SaleLine = pool.get('sale.line')
+        columns = {
+            'purchases': trace.purchase,
+            'purchase_requests': trace.purchase_request,
+            }
+        queries = [lambda sub_ids: trace.select(trace.sale,
+                *[columns[n] for n in names],
+                where=reduce_ids(trace.sale, sub_ids))]
 
-        purchases = set()
-        for reservation in self.get_recursive_reservations():
-            if reservation.source and reservation.source.origin:
-                origin = reservation.source.origin
-                if isinstance(origin, PurchaseLine):
-                    purchases.add(origin.purchase)
-            elif reservation.source_document and isinstance(
-                    reservation.source_document, PurchaseLine):
-                purchases.add(reservation.source_document.purchase)
         # support sale_supply(_drop_shipment)
         if hasattr(SaleLine, 'purchase_request'):
-            for line in self.lines:
-                if line.purchase_request and line.purchase_request.purchase:
-                    purchases.add(line.purchase_request.purchase)
-        return [p.id for p in purchases]
+            line = SaleLine.__table__()
+            request = Request.__table__()
+            purchase_line = PurchaseLine.__table__()
+            line_columns = {
+                'purchases': purchase_line.purchase,
+                'purchase_requests': request.id,
+                }
+            queries.append(lambda sub_ids: line.join(request,
+                    condition=request.id == line.purchase_request
+                    ).join(purchase_line, 'LEFT',
+                    condition=purchase_line.id == request.purchase_line
+                    ).select(line.sale, *[line_columns[n] for n in names],
+                    where=reduce_ids(line.sale, sub_ids)))
+
+        res = dict((n, dict((s.id, set()) for s in sales)) for n in names)
+        for sub_ids in grouped_slice([s.id for s in sales]):
+            sub_ids = list(sub_ids)
+            for query in queries:
+                cursor.execute(*query(sub_ids))
+                for row in cursor.fetchall():
+                    for name, value in zip(names, row[1:]):
+                        if value is not None:
+                            res[name][row[0]].add(value)
+        for name in names:
+            res[name] = dict((k, list(v)) for k, v in res[name].iteritems())
+        return res
 
     @classmethod
     def search_purchases(cls, name, clause):
         pool = Pool()
-        Purchase = pool.get('purchase.purchase')
-        sales = set()
-        for purchase in Purchase.search([('id',) + tuple(clause[1:])]):
-            for sale in purchase.sales:
-                sales.add(sale.id)
-        return [('id', 'in', sales)]
+        Trace = pool.get('stock.reservation.trace')
+        return Trace.search_related('sale', 'purchase', clause)
 
-    def get_purchase_requests(self, name):
+    @classmethod
+    def search_purchase_requests(cls, name, clause):
         pool = Pool()
-        Request = pool.get('purchase.request')
-        SaleLine = pool.get('sale.line')
+        Trace = pool.get('stock.reservation.trace')
+        return Trace.search_related('sale', 'purchase_request', clause)
 
-        requests = set()
-        for reservation in self.get_recursive_reservations():
-            if reservation.source_document and isinstance(
-                    reservation.source_document, Request):
-                requests.add(reservation.source_document)
-        # support sale_supply(_drop_shipment)
-        if hasattr(SaleLine, 'purchase_request'):
-            for line in self.lines:
-                if line.purchase_request:
-                    requests.add(line.purchase_request)
-        return [r.id for r in requests]
+
+class SaleLine:
+    __name__ = 'sale.line'
 
     @classmethod
-    def search_purchase_requests(cls, name, clause):
+    def write(cls, *args):
         pool = Pool()
-        Request = pool.get('purchase.request')
-        sales = set()
-        for request in Request.search([('id',) + tuple(clause[1:])]):
-            for sale in request.sales:
-                sales.add(sale.id)
-        return [('id', 'in', sales)]
+        Trace = pool.get('stock.reservation.trace')
+        actions = iter(args)
+        sale_ids = set()
+        for lines, values in zip(actions, actions):
+            if 'sale' in values:
+                sale_ids |= set(l.sale.id for l in lines)
+                if values['sale']:
+                    sale_ids.add(values['sale'])
+        super(SaleLine, cls).write(*args)
+        if sale_ids:
+            Trace.update_sales(sale_ids)
 
 
 class ShipmentOut(ReserveRelatedMixin):
@@ -2066,44 +3325,45 @@ class ShipmentOut(ReserveRelatedMixin):
         'get_ready_to_assign', searcher='search_ready_to_assign')
 
     @classmethod
-    def get_ready_to_assign(cls, shipments, name):
+    def _get_ready_to_assign_query(cls, shipment_ids=None):
+        '''
+        Return a query of the shipments with reservations that are all in
+        stock
+        '''
         pool = Pool()
         Reservation = pool.get('stock.reservation')
+        shipment = cls.__table__()
+        reservation = Reservation.__table__()
+        Char = Reservation.destination_document.sql_type().base
+
+        where = Literal(True)
+        if shipment_ids is not None:
+            where = reduce_ids(shipment.id, shipment_ids)
+        return shipment.join(reservation,
+            condition=reservation.destination_document == Concat(
+                Literal(cls.__name__ + ','), Cast(shipment.id, Char))
+            ).select(shipment.id,
+            where=where,
+            group_by=[shipment.id],
+            having=Min(Case((reservation.get_from_stock, 1), else_=0)) == 1)
 
-        inventory_moves = [m for s in shipments for m in s.inventory_moves]
-        reserves = Reservation.search([
-                ('destination', 'in', inventory_moves)
-                ])
-
-        reserves_by_shipment = {}
-        for reserve in reserves:
-            reserves_by_shipment.setdefault(reserve.destination.shipment.id,
-                []).append(bool(reserve.reserve_type == 'in_stock'))
+    @classmethod
+    def get_ready_to_assign(cls, shipments, name):
+        cursor = Transaction().connection.cursor()
 
-        res = {}
-        for shipment in shipments:
-            res[shipment.id] = (all(reserves_by_shipment[shipment.id])
-                if shipment.id in reserves_by_shipment else False)
-        return res
+        ready = set()
+        for sub_ids in grouped_slice([s.id for s in shipments]):
+            cursor.execute(*cls._get_ready_to_assign_query(list(sub_ids)))
+            ready.update(s for s, in cursor.fetchall())
+        return dict((s.id, s.id in ready) for s in shipments)
 
     @classmethod
     def search_ready_to_assign(cls, name, clause):
-        pool = Pool()
-        Reservation = pool.get('stock.reservation')
-
-        reserves = Reservation.search([
-                ('reserve_type', '=', 'in_stock'),
-                ])
-
-        shipments = set()
-        for reserve in reserves:
-            shipment = reserve.destination_document or (reserve.destination
-                and reserve.destination.shipment)
-            if isinstance(shipment, cls):
-                shipments.add(shipment)
-
-        operator = 'in' if clause[2] else 'not in'
-        return [('id', operator, [x.id for x in shipments])]
+        ready = bool(clause[2])
+        if clause[1] == '!=':
+            ready = not ready
+        query = cls._get_ready_to_assign_query()
+        return [('id', 'in' if ready else 'not in', query)]
 
 
 class ShipmentOutReturn:
@@ -2126,23 +3386,37 @@ class ShipmentIn:
 
         super(ShipmentIn, cls).create_inventory_moves(shipments)
 
+        line2move = {}
         for shipment in shipments:
+            incoming_moves = {}
+            for incoming_move in shipment.incoming_moves:
+                incoming_moves.setdefault((incoming_move.product.id,
+                        incoming_move.internal_quantity), incoming_move)
             for inventory_move in shipment.inventory_moves:
-                for incoming_move in shipment.incoming_moves:
-                    if (inventory_move.product == incoming_move.product and
-                            (inventory_move.internal_quantity ==
-                                incoming_move.internal_quantity)):
-                        if isinstance(incoming_move.origin, PurchaseLine):
-                            reserves = Reservation.search([
-                                    ('state', 'in', ['draft', 'waiting']),
-                                    ('source_document', '=',
-                                        str(incoming_move.origin)),
-                                    ])
-                            if reserves:
-                                Reservation.write(reserves, {
-                                        'source': inventory_move.id,
-                                        })
-                        break
+                incoming_move = incoming_moves.get((
+                        inventory_move.product.id,
+                        inventory_move.internal_quantity))
+                if (incoming_move
+                        and isinstance(incoming_move.origin, PurchaseLine)):
+                    line2move[incoming_move.origin.id] = inventory_move.id
+        if not line2move:
+            return
+
+        reserves = Reservation.search([
+                ('state', 'in', ['draft', 'waiting']),
+                ('source_document_model', '=', 'purchase.line'),
+                ('source_document_id', 'in', line2move.keys()),
+                ])
+        to_write = defaultdict(list)
+        for reserve in reserves:
+            to_write[line2move[reserve.source_document_id]].append(reserve)
+        args = []
+        for move_id, move_reserves in to_write.iteritems():
+            args.extend((move_reserves, {
+                        'source': move_id,
+                        }))
+        if args:
+            Reservation.write(*args)
 
     @classmethod
     def delete(cls, shipments):
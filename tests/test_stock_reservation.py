@@ -1,18 +1,79 @@
 #!/usr/bin/env python
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from datetime import datetime, timedelta
 from decimal import Decimal
 import unittest
 import doctest
 import trytond.tests.test_tryton
 from trytond.pool import Pool
+from trytond.transaction import Transaction
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
-from trytond.exceptions import UserWarning
+from trytond.exceptions import UserError, UserWarning
 
 from trytond.modules.company.tests import create_company, set_company
 
 
+def create_reservation(company):
+    '''
+    Create a reservation of a move from the supplier to the storage for a
+    move from the storage to the output
+    '''
+    pool = Pool()
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    Uom = pool.get('product.uom')
+    Location = pool.get('stock.location')
+    Move = pool.get('stock.move')
+    Reservation = pool.get('stock.reservation')
+
+    kg, = Uom.search([('name', '=', 'Kilogram')])
+    template, = Template.create([{
+                'name': 'Reserved',
+                'type': 'goods',
+                'list_price': Decimal(1),
+                'cost_price': Decimal(0),
+                'cost_price_method': 'fixed',
+                'default_uom': kg.id,
+                }])
+    product, = Product.create([{
+                'template': template.id,
+                }])
+    supplier, = Location.search([('code', '=', 'SUP')])
+    storage, = Location.search([('code', '=', 'STO')])
+    output, = Location.search([('code', '=', 'OUT')])
+    source, destination = Move.create([{
+                'product': product.id,
+                'uom': kg.id,
+                'quantity': 1.0,
+                'from_location': supplier.id,
+                'to_location': storage.id,
+                'company': company.id,
+                'unit_price': Decimal('1'),
+                'currency': company.currency.id,
+                }, {
+                'product': product.id,
+                'uom': kg.id,
+                'quantity': 1.0,
+                'from_location': storage.id,
+                'to_location': output.id,
+                'company': company.id,
+                'unit_price': Decimal('1'),
+                'currency': company.currency.id,
+                }])
+    reservation, = Reservation.create([{
+                'product': product.id,
+                'uom': kg.id,
+                'quantity': 1.0,
+                'location': storage.id,
+                'company': company.id,
+                'source': source.id,
+                'destination': destination.id,
+                }])
+    return reservation
+
+
 class StockReservationTestCase(ModuleTestCase):
     'Test Stock Reservation module'
     module = 'stock_reservation'
@@ -92,6 +153,486 @@ class StockReservationTestCase(ModuleTestCase):
                             field: value,
                             })
 
+    @with_transaction()
+    def test0020_production_ready_to_assign(self):
+        'Test production ready to assign with reservations in another UoM'
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Production = pool.get('production')
+        Reservation = pool.get('stock.reservation')
+
+        kg, = Uom.search([('name', '=', 'Kilogram')])
+        g, = Uom.search([('name', '=', 'Gram')])
+        template, = Template.create([{
+                    'name': 'Component',
+                    'type': 'goods',
+                    'list_price': Decimal(1),
+                    'cost_price': Decimal(0),
+                    'cost_price_method': 'fixed',
+                    'default_uom': kg.id,
+                    }])
+        product, = Product.create([{
+                    'template': template.id,
+                    }])
+        warehouse, = Location.search([('code', '=', 'WH')])
+        storage, = Location.search([('code', '=', 'STO')])
+        production_location, = Location.search([
+                ('type', '=', 'production'),
+                ])
+        company = create_company()
+        with set_company(company):
+            production, = Production.create([{
+                        'company': company.id,
+                        'warehouse': warehouse.id,
+                        'location': production_location.id,
+                        'inputs': [('create', [{
+                                        'product': product.id,
+                                        'uom': kg.id,
+                                        'quantity': 1.0,
+                                        'from_location': storage.id,
+                                        'to_location': production_location.id,
+                                        'company': company.id,
+                                        }])],
+                        }])
+            input_, = production.inputs
+            reservation, = Reservation.create([{
+                        'product': product.id,
+                        'uom': g.id,
+                        'quantity': 500.0,
+                        'location': storage.id,
+                        'company': company.id,
+                        'destination': input_.id,
+                        'get_from_stock': True,
+                        'stock_location': storage.id,
+                        }])
+            production = Production(production.id)
+            self.assertFalse(production.ready_to_assign)
+            self.assertEqual(Production.search([
+                        ('id', '=', production.id),
+                        ('ready_to_assign', '=', True),
+                        ]), [])
+
+            Reservation.write([reservation], {
+                    'quantity': 1000.0,
+                    })
+            production = Production(production.id)
+            self.assertTrue(production.ready_to_assign)
+            self.assertEqual(Production.search([
+                        ('id', '=', production.id),
+                        ('ready_to_assign', '=', True),
+                        ]), [production])
+
+    @with_transaction()
+    def test0030_generation_stale(self):
+        'Test a stale running generation does not block a new one'
+        pool = Pool()
+        Generation = pool.get('stock.reservation.generation')
+
+        running, = Generation.create([{
+                    'state': 'running',
+                    'progress_date': datetime.now(),
+                    }])
+        self.assertEqual(Generation.get_active(), running)
+        self.assertRaises(UserError, Generation.enqueue)
+
+        Generation.write([running], {
+                'progress_date': datetime.now() - timedelta(days=1),
+                })
+        self.assertEqual(Generation.get_active(), None)
+        pending = Generation.enqueue()
+        self.assertEqual(pending.state, 'pending')
+        self.assertEqual(pending.user.id, Transaction().user)
+        self.assertEqual(running.state, 'failed')
+
+    @with_transaction()
+    def test0040_trace_follows_moves(self):
+        'Test the sale traces are refreshed when the moves change'
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Party = pool.get('party.party')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        ShipmentOut = pool.get('stock.shipment.out')
+        Production = pool.get('production')
+        Reservation = pool.get('stock.reservation')
+        Trace = pool.get('stock.reservation.trace')
+
+        kg, = Uom.search([('name', '=', 'Kilogram')])
+        template, = Template.create([{
+                    'name': 'Traced',
+                    'type': 'goods',
+                    'list_price': Decimal(1),
+                    'cost_price': Decimal(0),
+                    'cost_price_method': 'fixed',
+                    'default_uom': kg.id,
+                    }])
+        product, = Product.create([{
+                    'template': template.id,
+                    }])
+        warehouse, = Location.search([('code', '=', 'WH')])
+        storage, = Location.search([('code', '=', 'STO')])
+        output, = Location.search([('code', '=', 'OUT')])
+        customer_location, = Location.search([('code', '=', 'CUS')])
+        production_loc, = Location.search([
+                ('type', '=', 'production'),
+                ])
+        company = create_company()
+        payment_term, = PaymentTerm.create([{
+                    'name': 'Direct',
+                    'lines': [('create', [{'type': 'remainder'}])],
+                    }])
+        customer, = Party.create([{
+                    'name': 'Customer',
+                    'addresses': [('create', [{}])],
+                    }])
+        address, = customer.addresses
+
+        def traced(sale):
+            return set(t.reservation for t in Trace.search([
+                        ('sale', '=', sale.id),
+                        ]))
+
+        with set_company(company):
+            sale1, sale2 = Sale.create([{
+                        'company': company.id,
+                        'party': customer.id,
+                        'invoice_address': address.id,
+                        'shipment_address': address.id,
+                        'payment_term': payment_term.id,
+                        'currency': company.currency.id,
+                        'lines': [('create', [{
+                                        'description': 'Line',
+                                        'quantity': 1.0,
+                                        'unit_price': Decimal(1),
+                                        }])],
+                        } for _ in range(2)])
+            line1, = sale1.lines
+            line2, = sale2.lines
+            shipment, = ShipmentOut.create([{
+                        'company': company.id,
+                        'customer': customer.id,
+                        'delivery_address': address.id,
+                        'warehouse': warehouse.id,
+                        }])
+            production, = Production.create([{
+                        'company': company.id,
+                        'warehouse': warehouse.id,
+                        'location': production_loc.id,
+                        'inputs': [('create', [{
+                                        'product': product.id,
+                                        'uom': kg.id,
+                                        'quantity': 1.0,
+                                        'from_location': storage.id,
+                                        'to_location': production_loc.id,
+                                        'company': company.id,
+                                        }])],
+                        'outputs': [('create', [{
+                                        'product': product.id,
+                                        'uom': kg.id,
+                                        'quantity': 1.0,
+                                        'from_location': production_loc.id,
+                                        'to_location': storage.id,
+                                        'company': company.id,
+                                        'unit_price': Decimal(1),
+                                        'currency': company.currency.id,
+                                        }])],
+                        }])
+            input_, = production.inputs
+            output_, = production.outputs
+            inventory_move, = Move.create([{
+                        'product': product.id,
+                        'uom': kg.id,
+                        'quantity': 1.0,
+                        'from_location': storage.id,
+                        'to_location': output.id,
+                        'company': company.id,
+                        'shipment': str(shipment),
+                        }])
+            from_production, from_stock = Reservation.create([{
+                        'product': product.id,
+                        'uom': kg.id,
+                        'quantity': 1.0,
+                        'location': storage.id,
+                        'company': company.id,
+                        'source': output_.id,
+                        'destination': inventory_move.id,
+                        }, {
+                        'product': product.id,
+                        'uom': kg.id,
+                        'quantity': 1.0,
+                        'location': storage.id,
+                        'company': company.id,
+                        'destination': input_.id,
+                        'get_from_stock': True,
+                        'stock_location': storage.id,
+                        }])
+            self.assertEqual(traced(sale1), set())
+
+            # Creating the sale move in the shipment links the sale
+            sale_move, = Move.create([{
+                        'product': product.id,
+                        'uom': kg.id,
+                        'quantity': 1.0,
+                        'from_location': output.id,
+                        'to_location': customer_location.id,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        'origin': str(line1),
+                        'shipment': str(shipment),
+                        }])
+            self.assertEqual(traced(sale1),
+                set([from_production, from_stock]))
+
+            # Production inputs are followed
+            Move.write([input_], {
+                    'production_input': None,
+                    })
+            self.assertEqual(traced(sale1), set([from_production]))
+            Move.write([input_], {
+                    'production_input': production.id,
+                    })
+            self.assertEqual(traced(sale1),
+                set([from_production, from_stock]))
+
+            # Changing the origin moves the traces to the other sale
+            Move.write([sale_move], {
+                    'origin': str(line2),
+                    })
+            self.assertEqual(traced(sale1), set())
+            self.assertEqual(traced(sale2),
+                set([from_production, from_stock]))
+
+            # Moving the sale line relinks the sales
+            SaleLine.write([line2], {
+                    'sale': sale1.id,
+                    })
+            self.assertEqual(traced(sale1),
+                set([from_production, from_stock]))
+            self.assertEqual(traced(sale2), set())
+
+            # Removing the sale move from the shipment unlinks the sale
+            Move.write([sale_move], {
+                    'shipment': None,
+                    })
+            self.assertEqual(traced(sale1), set())
+            Move.write([sale_move], {
+                    'shipment': str(shipment),
+                    })
+            self.assertEqual(traced(sale1),
+                set([from_production, from_stock]))
+
+            # The generator walks the same reservations level by level
+            generator = sale1.get_recursive_reservations_generator()
+            self.assertEqual(next(generator), from_production)
+            self.assertEqual(list(generator), [from_stock])
+            self.assertEqual(set(sale1.get_recursive_reservations()),
+                set([from_production, from_stock]))
+
+            # The reservations deleted with their moves are not traced
+            with Transaction().set_context(ignore_reserve_warnings=True):
+                Move.delete([input_])
+            self.assertEqual(traced(sale1), set([from_production]))
+
+    @with_transaction()
+    def test0050_move_fields(self):
+        'Test the reservation fields read from its moves'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Reservation = pool.get('stock.reservation')
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        output, = Location.search([('code', '=', 'OUT')])
+        company = create_company()
+        with set_company(company):
+            reservation = create_reservation(company)
+            self.assertEqual(reservation.source_from_location, supplier)
+            self.assertEqual(reservation.source_to_location, storage)
+            self.assertEqual(reservation.destination_from_location, storage)
+            self.assertEqual(reservation.destination_to_location, output)
+            self.assertEqual(reservation.destination_planned_date, None)
+            self.assertEqual(Reservation.search([
+                        ('id', '=', reservation.id),
+                        ('destination_planned_date', '=', None),
+                        ]), [reservation])
+
+    @with_transaction()
+    def test0060_destination_document(self):
+        'Test destination_document follows the destination move'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        ShipmentInternal = pool.get('stock.shipment.internal')
+        Reservation = pool.get('stock.reservation')
+
+        storage, = Location.search([('code', '=', 'STO')])
+        output, = Location.search([('code', '=', 'OUT')])
+        company = create_company()
+        with set_company(company):
+            reservation = create_reservation(company)
+            self.assertEqual(reservation.destination_document, None)
+
+            shipment, = ShipmentInternal.create([{
+                        'from_location': storage.id,
+                        'to_location': output.id,
+                        'company': company.id,
+                        }])
+            Move.write([reservation.destination], {
+                    'shipment': str(shipment),
+                    })
+            reservation = Reservation(reservation.id)
+            self.assertEqual(reservation.destination_document, shipment)
+            self.assertEqual(Reservation.search([
+                        ('destination_document', '=', str(shipment)),
+                        ]), [reservation])
+
+            # A move created in the shipment is followed once reserved
+            move, = Move.create([{
+                        'product': reservation.product.id,
+                        'uom': reservation.uom.id,
+                        'quantity': 1.0,
+                        'from_location': storage.id,
+                        'to_location': output.id,
+                        'company': company.id,
+                        'shipment': str(shipment),
+                        }])
+            other, = Reservation.create([{
+                        'product': reservation.product.id,
+                        'uom': reservation.uom.id,
+                        'quantity': 1.0,
+                        'location': storage.id,
+                        'company': company.id,
+                        'destination': move.id,
+                        }])
+            self.assertEqual(other.destination_document, shipment)
+
+            Move.write([reservation.destination], {
+                    'shipment': None,
+                    })
+            Reservation.write([other], {
+                    'destination': reservation.destination.id,
+                    })
+            self.assertEqual(other.destination_document, None)
+            self.assertEqual(Reservation.search([
+                        ('destination_document', '=', str(shipment)),
+                        ]), [])
+
+    @with_transaction()
+    def test0070_source_document_columns(self):
+        'Test the source document is stored by model and id'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        ShipmentInternal = pool.get('stock.shipment.internal')
+        Reservation = pool.get('stock.reservation')
+
+        storage, = Location.search([('code', '=', 'STO')])
+        output, = Location.search([('code', '=', 'OUT')])
+        company = create_company()
+        with set_company(company):
+            reservation = create_reservation(company)
+            self.assertEqual(reservation.source_document_model, None)
+            self.assertEqual(reservation.source_document_id, None)
+
+            shipment, = ShipmentInternal.create([{
+                        'from_location': storage.id,
+                        'to_location': output.id,
+                        'company': company.id,
+                        }])
+            Reservation.write([reservation], {
+                    'source_document': str(shipment),
+                    })
+            self.assertEqual(reservation.source_document_model,
+                'stock.shipment.internal')
+            self.assertEqual(reservation.source_document_id, shipment.id)
+            self.assertEqual(Reservation.search([
+                        ('source_document_model', '=',
+                            'stock.shipment.internal'),
+                        ('source_document_id', '=', shipment.id),
+                        ]), [reservation])
+
+            Reservation.write([reservation], {
+                    'source_document': None,
+                    })
+            self.assertEqual(reservation.source_document_model, None)
+            self.assertEqual(reservation.source_document_id, None)
+
+    @with_transaction()
+    def test0080_move_chain(self):
+        'Test moves are followed through the reservations'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Reservation = pool.get('stock.reservation')
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            reservation = create_reservation(company)
+            source, destination = reservation.source, reservation.destination
+            for start, forward, result in [
+                    (destination, False, set([destination.id, source.id])),
+                    (source, True, set([source.id, destination.id])),
+                    (source, False, set([source.id])),
+                    (destination, True, set([destination.id])),
+                    ]:
+                chain = Reservation.get_move_chain(move.select(move.id,
+                        move.id, where=move.id == start.id), forward=forward)
+                cursor.execute(*chain.select(chain.move))
+                self.assertEqual(set(m for m, in cursor.fetchall()), result)
+
+    @with_transaction()
+    def test0100_document_selection_cache(self):
+        'Test the document selections are cached by models and language'
+        pool = Pool()
+        Reservation = pool.get('stock.reservation')
+
+        selection = Reservation.get_destination_document_selection()
+        self.assertIn(('stock.shipment.internal', 'Internal Shipment'),
+            selection)
+        models = Reservation._get_destination_document_models()
+        self.assertEqual(Reservation._document_selection_cache.get(
+                ('destination_document', tuple(models),
+                    Transaction().language)),
+            selection)
+        self.assertEqual(Reservation._get_document_selection(
+                'destination_document', ['stock.shipment.internal']),
+            [('', ''), ('stock.shipment.internal', 'Internal Shipment')])
+
+    @with_transaction()
+    def test0110_location_descendants(self):
+        'Test location descendants are refreshed when the tree changes'
+        pool = Pool()
+        Location = pool.get('stock.location')
+
+        storage, = Location.search([('code', '=', 'STO')])
+        output, = Location.search([('code', '=', 'OUT')])
+        self.assertEqual(Location.get_descendant_ids(storage.id),
+            (storage.id,))
+        child, = Location.create([{
+                    'name': 'Child',
+                    'type': 'storage',
+                    'parent': storage.id,
+                    }])
+        self.assertEqual(set(Location.get_descendant_ids(storage.id)),
+            set([storage.id, child.id]))
+        Location.write([child], {
+                'parent': output.id,
+                })
+        self.assertEqual(Location.get_descendant_ids(storage.id),
+            (storage.id,))
+        Location.delete([child])
+        self.assertEqual(Location.get_descendant_ids(output.id),
+            (output.id,))
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -107,4 +648,7 @@ def suite():
             'scenario_stock_reservation_child_locations.rst',
             setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',
             optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
+    suite.addTests(doctest.DocFileSuite('scenario_stock_reservation_sale.rst',
+            setUp=doctest_setup, tearDown=doctest_teardown, encoding='utf-8',
+            optionflags=doctest.REPORT_ONLY_FIRST_FAILURE))
     return suite